@@ -0,0 +1,159 @@
+# coding=utf-8
+"""Record/replay cache of WG API responses
+
+Mode is set by WG_API_CACHE['MODE'] setting:
+
+* None - cache is disabled, every call goes to WG API
+* 'record' - every call goes to WG API, responses are written to the store
+* 'replay' - responses are served only from the store, missing ones raise CacheMiss
+* 'ttl' - responses younger than WG_API_CACHE['TTL'] seconds are served from
+  the store, others are fetched and stored
+
+Store is a directory of gzipped JSON files keyed by endpoint and params, so an
+import recorded once can be replayed offline for debugging and benchmarks.
+"""
+from __future__ import unicode_literals
+
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+from django.conf import settings
+from wargaming.exceptions import RequestError
+
+from global_map import metrics
+from global_map.rate_limit import throttled, wg_api_bucket
+
+
+class CacheMiss(Exception):
+    pass
+
+
+class ResponseCache(object):
+    modes = (None, 'record', 'replay', 'ttl')
+
+    def __init__(self, mode=None, path=None, ttl=60):
+        if mode not in self.modes:
+            raise ValueError("Unknown WG API cache mode '%s'" % mode)
+        self.mode = mode
+        self.path = path
+        self.ttl = ttl
+
+    @staticmethod
+    def key(endpoint, params):
+        params = {k: v for k, v in (params or {}).items() if v is not None}
+        return hashlib.sha1(json.dumps([endpoint, params], sort_keys=True).encode('utf-8')).hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.path, key[:2], key + '.json.gz')
+
+    def read(self, key, max_age=None):
+        try:
+            with gzip.open(self.filename(key), 'rb') as f:
+                record = json.loads(f.read().decode('utf-8'))
+        except (IOError, OSError):
+            return None
+        if max_age is not None and time.time() - record['created_at'] > max_age:
+            return None
+        return record
+
+    def write(self, key, endpoint, params, data):
+        filename = self.filename(key)
+        dirname = os.path.dirname(filename)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:  # created by concurrent import
+                pass
+        record = {'endpoint': endpoint, 'params': params, 'created_at': time.time(), 'data': data}
+        # write to temporary file and rename, so readers never see partial records
+        fd, tmp_filename = tempfile.mkstemp(dir=dirname)
+        with os.fdopen(fd, 'wb') as raw, gzip.GzipFile(fileobj=raw, mode='wb') as f:
+            f.write(json.dumps(record).encode('utf-8'))
+        os.rename(tmp_filename, filename)
+
+    def call(self, endpoint, params, fetch):
+        """Return response of endpoint called with params, fetch() does the real call"""
+        if self.mode is None:
+            return fetch()
+
+        key = self.key(endpoint, params)
+        if self.mode == 'replay':
+            record = self.read(key)
+            if record is None:
+                raise CacheMiss('No recorded response for %s %s' % (endpoint, json.dumps(params, sort_keys=True)))
+            return record['data']
+
+        if self.mode == 'ttl':
+            record = self.read(key, max_age=self.ttl)
+            if record is not None:
+                return record['data']
+
+        data = fetch()
+        self.write(key, endpoint, params, data)
+        return data
+
+
+class CachedClient(object):
+    """Proxy for wargaming.WoT and wargaming.WGN clients
+
+    wot.globalmap.provinces(**params) is served through response cache and
+    always returns plain data instead of lazy wargaming response object.
+    With base_url set, methods are called over HTTP at base_url instead of
+    the real WG API, e.g. on fake_wgapi stand-in server.
+    """
+
+    def __init__(self, client, name, base_url=None):
+        self._client = client
+        self._name = name
+        self._base_url = base_url
+
+    def __getattr__(self, attr):
+        return CachedClient(getattr(self._client, attr), '%s.%s' % (self._name, attr), self._base_url)
+
+    def __call__(self, **params):
+        return response_cache.call(self._name, params, lambda: self._fetch(params))
+
+    def _fetch(self, params):
+        def request():
+            start = time.time()
+            error = None
+            try:
+                if self._base_url:
+                    return self._request(params)
+                result = self._client(**params)
+                return getattr(result, 'data', result)
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                metrics.observe_api_call('wg_api', self._name, time.time() - start, error)
+        return throttled(wg_api_bucket, request)
+
+    def _request(self, params):
+        from global_map.game_api import get_session  # game_api depends on this module
+
+        params = dict(params, application_id=settings.WARGAMING_KEY)
+        resp = get_session().get(self._base_url + self._name.replace('.', '/') + '/', params=params,
+                                 timeout=settings.GAME_API_TIMEOUT)
+        resp.raise_for_status()
+        result = resp.json()
+        if result.get('status') != 'ok':
+            error = result.get('error') or {}
+            raise RequestError(error.get('code'), error.get('field'), error.get('message'), error.get('value'))
+        return result['data']
+
+
+def from_settings():
+    config = settings.WG_API_CACHE
+    return ResponseCache(
+        mode=config.get('MODE'),
+        path=config.get('PATH'),
+        ttl=config.get('TTL', 60),
+    )
+
+
+response_cache = from_settings()
@@ -0,0 +1,53 @@
+# coding=utf-8
+"""Versions of battle schedules of a clan on a date
+
+Importer bumps version of every (clan, date) it changed, after the change is
+committed. Views cache responses with the version they were built for, so a
+cached response is valid until the next import changes its data. Versions are
+kept in the cache shared by all uwsgi workers and importers; a lost version
+only means one more rebuild.
+"""
+from __future__ import unicode_literals
+
+import time
+
+from django.core.cache import cache
+
+
+def version_key(clan_id, date):
+    return 'data_version:%s:%s' % (clan_id, date)
+
+
+def new_version():
+    # grows with time, so a version is never reused after it was lost from the cache
+    return '%x' % int(time.time() * 1000000)
+
+
+def bump(clan_dates):
+    """Bump versions of iterable of (clan_id, date)"""
+    version = new_version()
+    keys = {version_key(clan_id, date): version for clan_id, date in set(clan_dates) if clan_id}
+    if keys:
+        cache.set_many(keys, timeout=None)
+
+
+def get_with_version(clan_id, date, key):
+    """Returns (current version, value cached by key for this version or None)
+
+    Both keys are read with one get_many, DatabaseCache runs it as a query per key.
+    """
+    v_key = version_key(clan_id, date)
+    values = cache.get_many([v_key, key])
+    version = values.get(v_key)
+    if version is None:
+        version = new_version()
+        cache.add(v_key, version, timeout=None)
+        return version, None
+    entry = values.get(key)
+    if entry is None or entry['version'] != version:
+        return version, None
+    return version, entry['value']
+
+
+def set_with_version(key, version, value, timeout):
+    cache.set(key, {'version': version, 'value': value}, timeout=timeout)
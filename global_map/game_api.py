@@ -0,0 +1,179 @@
+# coding=utf-8
+"""Client for unofficial WG global map API (the one used by the global map site itself)
+
+All requests share one pooled keep-alive session, so TLS handshake to
+ru.wargaming.net is done once per pooled connection instead of once per call.
+"""
+from __future__ import unicode_literals
+
+from collections import defaultdict
+import json
+import logging
+import re
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+
+from global_map import metrics
+from global_map.api_cache import response_cache
+from global_map.rate_limit import throttled, game_api_bucket
+
+logger = logging.getLogger(__name__)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            session.headers['Accept-Encoding'] = 'gzip, deflate'
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=settings.GAME_API_POOL_SIZE,
+                pool_block=True,  # never open more than pool_maxsize connections
+            )
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+    return _session
+
+
+def reset_session():
+    """Drop pooled connections, forked processes must not share sockets with parent"""
+    global _session
+    with _session_lock:
+        _session = None
+
+
+class LatencyStats(object):
+    """Thread-safe per-endpoint request latency counters"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = defaultdict(lambda: [0, 0.0, 0.0])  # count, total, max
+
+    def add(self, endpoint, seconds):
+        with self._lock:
+            stat = self._stats[endpoint]
+            stat[0] += 1
+            stat[1] += seconds
+            stat[2] = max(stat[2], seconds)
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                endpoint: {'count': count, 'avg': total / count, 'max': max_seconds}
+                for endpoint, (count, total, max_seconds) in self._stats.items()
+            }
+
+    def log_report(self):
+        for endpoint, stat in sorted(self.as_dict().items()):
+            logger.info("game_api %s: %s requests, avg %.3fs, max %.3fs",
+                        endpoint, stat['count'], stat['avg'], stat['max'])
+
+
+latency = LatencyStats()
+
+
+def endpoint_name(path):
+    """clan/35039/log -> clan/<id>/log"""
+    return re.sub(r'\d+', '<id>', path.split('?')[0])
+
+
+def get(path, params=None, **kwargs):
+    kwargs.setdefault('timeout', settings.GAME_API_TIMEOUT)
+
+    def request():
+        start = time.time()
+        error = None
+        try:
+            resp = get_session().get(settings.GAME_API_URL + path, params=params, **kwargs)
+            resp.raise_for_status()
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            seconds = time.time() - start
+            latency.add(endpoint_name(path), seconds)
+            metrics.observe_api_call('game_api', endpoint_name(path), seconds, error)
+        return resp
+
+    return throttled(game_api_bucket, request)
+
+
+def iter_array_items(chunks, key):
+    """Incrementally decode items of array stored by key in JSON object
+
+    chunks is an iterable of text pieces of the document. Only current item
+    and one chunk are kept in memory. Array items must be objects, key must
+    be the first occurrence of '"key"' in the document.
+    """
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    marker = '"%s"' % key
+    buf = ''
+
+    # skip everything until the beginning of array
+    while True:
+        start = buf.find(marker)
+        if start != -1:
+            start = buf.find('[', start + len(marker))
+            if start != -1:
+                buf = buf[start + 1:]
+                break
+        chunk = next(chunks, None)
+        if chunk is None:
+            return
+        buf += chunk
+
+    while True:
+        buf = buf.lstrip(' \t\r\n,')
+        if buf.startswith(']'):
+            return
+        if buf:
+            try:
+                item, end = decoder.raw_decode(buf)
+            except ValueError:  # item is not complete yet
+                pass
+            else:
+                yield item
+                buf = buf[end:]
+                continue
+        chunk = next(chunks, None)
+        if chunk is None:
+            raise ValueError('Unexpected end of JSON document')
+        buf += chunk
+
+
+def iter_json_items(path, key, params=None, **kwargs):
+    """Yield items of response[key] array without loading whole response into memory"""
+    if response_cache.mode is not None:
+        # cache stores complete responses
+        for item in get_json(path, params=params, **kwargs)[key]:
+            yield item
+        return
+
+    resp = get(path, params=params, stream=True, **kwargs)
+    try:
+        resp.encoding = resp.encoding or 'utf-8'
+        for item in iter_array_items(resp.iter_content(chunk_size=8192, decode_unicode=True), key):
+            yield item
+    finally:
+        resp.close()
+
+
+def get_json(path, params=None, **kwargs):
+    if 'headers' in kwargs:
+        # personalized response (e.g. with clan cookie), never cache it
+        return get(path, params=params, **kwargs).json()
+    return response_cache.call('game_api/' + path, params, lambda: get(path, params=params, **kwargs).json())
@@ -0,0 +1,464 @@
+"""Local stand-in of WG API and global map game API for load testing
+
+Serves a generated global map with tournaments, which evolve in time: every
+day of the map lasts rounds_per_day * round_seconds, rounds of every
+province are played one after another, results go to clan logs. Point the
+importer to it with:
+
+    WG_API_URL=http://127.0.0.1:8800/wgapi/ GAME_API_URL=http://127.0.0.1:8800/game_api/ \\
+        ./manage.py fetchdata --workers 8 1000 1001
+"""
+from __future__ import unicode_literals
+
+from datetime import datetime, timedelta
+import json
+import logging
+import random
+import re
+import threading
+import time
+
+import pytz
+from django.core.management.base import BaseCommand
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import urlparse, parse_qsl
+
+logger = logging.getLogger(__name__)
+
+competitors_count = 8  # 3 rounds of tournament, then battle with owner
+rounds_per_day = 6  # 4 rounds and a break before the next day
+first_clan_id = 1000
+
+wg_datetime_format = '%Y-%m-%dT%H:%M:%S'
+log_datetime_format = '%Y-%m-%d %H:%M:%S'
+
+
+class ApiError(Exception):
+    def __init__(self, code, message, http_status=200):
+        super(ApiError, self).__init__(message)
+        self.code = code
+        self.message = message
+        self.http_status = http_status
+
+
+class FakeMap(object):
+    """Deterministic global map: state of every province is a function of time"""
+
+    def __init__(self, fronts=2, provinces=200, clans=300, round_seconds=60, seed=0, started_at=None):
+        self.fronts = ['front_%s' % i for i in range(fronts)]
+        self.provinces_count = provinces
+        self.clan_ids = list(range(first_clan_id, first_clan_id + clans))
+        self.round_seconds = round_seconds
+        self.seed = seed
+        self.started_at = (started_at or datetime.now(tz=pytz.UTC)).replace(microsecond=0)
+        self._lock = threading.Lock()
+        self._days = {}
+
+    def day_number(self, now):
+        return int((now - self.started_at).total_seconds() // (self.round_seconds * rounds_per_day))
+
+    def day(self, number):
+        """Tournaments of the day: {province_index: Tournament}, participants {clan_id: [province_index]}"""
+        with self._lock:
+            if number not in self._days:
+                self._days.pop(number - 2, None)
+                tournaments = {index: Tournament(self, number, index) for index in range(self.provinces_count)}
+                participants = {}
+                for index, tournament in tournaments.items():
+                    for clan_id in tournament.clan_ids:
+                        participants.setdefault(clan_id, []).append(index)
+                self._days[number] = tournaments, participants
+            return self._days[number]
+
+    def province_id(self, index):
+        return 'province_%s' % index
+
+    def province_index(self, province_id):
+        match = re.match(r'^province_(\d+)$', province_id or '')
+        if not match or int(match.group(1)) >= self.provinces_count:
+            return None
+        return int(match.group(1))
+
+    def front_id(self, index):
+        return self.fronts[index % len(self.fronts)]
+
+    def clan(self, clan_id):
+        return {
+            'clan_id': clan_id, 'id': clan_id, 'tag': 'C%s' % clan_id, 'name': 'Clan %s' % clan_id,
+            'elo_rating_6': 1000 + clan_id % 300, 'elo_rating_8': 1000 + clan_id % 400,
+            'elo_rating_10': 1000 + clan_id % 500, 'arena_wins_percent': 50.0, 'arena_battles_count': 10,
+        }
+
+    def tournaments(self, now):
+        return self.day(self.day_number(now))[0]
+
+    # WG API
+
+    def globalmap_info(self, params, now):
+        return {'state': 'active', 'last_turn': self.day_number(now)}
+
+    def globalmap_fronts(self, params, now):
+        return [{'front_id': front_id, 'max_vehicle_level': 10} for front_id in self.fronts]
+
+    def globalmap_provinces(self, params, now):
+        if params.get('front_id') not in self.fronts:
+            raise ApiError(402, 'FRONT_ID_NOT_SPECIFIED')
+        tournaments = self.tournaments(now)
+        indexes = [index for index in range(self.provinces_count) if self.front_id(index) == params['front_id']]
+        if params.get('province_id'):
+            requested = set(params['province_id'].split(','))
+            indexes = [index for index in indexes if self.province_id(index) in requested]
+        else:
+            limit = int(params.get('limit', 100))
+            page_no = int(params.get('page_no', 1))
+            indexes = indexes[(page_no - 1) * limit:page_no * limit]
+        return [tournaments[index].province_data(now) for index in indexes]
+
+    def globalmap_clanprovinces(self, params, now):
+        tournaments = self.tournaments(now)
+        result = {}
+        for clan_id in params['clan_id'].split(','):
+            owned = [
+                {'province_id': self.province_id(index), 'front_id': self.front_id(index)}
+                for index, tournament in tournaments.items() if tournament.owner_at(now) == int(clan_id)
+            ]
+            result[clan_id] = owned or None
+        return result
+
+    def clans_info(self, params, now):
+        return {
+            clan_id: self.clan(int(clan_id)) if int(clan_id) in self.clan_ids else None
+            for clan_id in params['clan_id'].split(',')
+        }
+
+    def clans_list(self, params, now):
+        return [self.clan(clan_id) for clan_id in self.clan_ids if self.clan(clan_id)['tag'] == params.get('search')]
+
+    def account_info(self, params, now):
+        return {account_id: {'clan_id': self.clan_ids[int(account_id) % len(self.clan_ids)]}
+                for account_id in params['account_id'].split(',')}
+
+    # game API
+
+    def tournament_info(self, params, now):
+        index = self.province_index(params.get('alias'))
+        if index is None:
+            raise ApiError(404, 'PROVINCE_NOT_FOUND', http_status=404)
+        return self.tournaments(now)[index].tournament_info(now)
+
+    def province_info(self, params, now):
+        index = self.province_index(params.get('alias'))
+        if index is None:
+            raise ApiError(404, 'PROVINCE_NOT_FOUND', http_status=404)
+        tournament = self.tournaments(now)[index]
+        owner_id = tournament.owner_at(now)
+        return {
+            'province': {
+                'arena_name': tournament.arena_name, 'neighbours': [], 'primetime': tournament.prime_time,
+                'name': tournament.province_name, 'turns_till_primetime': 0, 'periphery': 'RU1',
+            },
+            'owner': {'id': owner_id},
+        }
+
+    def clan_battles(self, clan_id, params, now):
+        tournaments, participants = self.day(self.day_number(now))
+        battles, planned = [], []
+        for index in participants.get(clan_id, []):
+            state = tournaments[index].clan_state(clan_id, now)
+            province = {'province_id': self.province_id(index), 'front_id': self.front_id(index)}
+            if state == 'battle':
+                battles.append(province)
+            elif state == 'planned':
+                planned.append(province)
+        return {'battles': battles, 'planned_battles': planned}
+
+    def clan_log(self, clan_id, params, now):
+        day_number = self.day_number(now)
+        entries = []
+        for number in (day_number - 1, day_number):
+            if number < 0:
+                continue
+            tournaments, participants = self.day(number)
+            for index in participants.get(clan_id, []):
+                entries.extend(tournaments[index].log_entries(clan_id, now))
+        entries.sort(key=lambda entry: entry['created_at'], reverse=True)
+        page_size = int(params.get('page_size', 20))
+        page_number = int(params.get('page_number', 1))
+        return {
+            'data': entries[(page_number - 1) * page_size:page_number * page_size],
+            'total': len(entries), 'page_number': page_number, 'page_size': page_size,
+        }
+
+
+class Tournament(object):
+    """Tournament of one province on one day of the map"""
+
+    def __init__(self, fake_map, day_number, index):
+        rng = random.Random(fake_map.seed * 1000003 + day_number * 7919 + index)
+        self.map = fake_map
+        self.index = index
+        self.province_id = fake_map.province_id(index)
+        self.province_name = 'Province %s' % index
+        self.arena_id = 'arena_%s' % (index % 20)
+        self.arena_name = 'Arena %s' % (index % 20)
+        self.day_start = fake_map.started_at + timedelta(seconds=day_number * fake_map.round_seconds * rounds_per_day)
+        # half of provinces start one round later
+        self.start_at = self.day_start + timedelta(seconds=(index % 2) * fake_map.round_seconds)
+        self.prime_time = self.start_at.strftime('%H:%M')
+        self.owner_id = rng.choice(fake_map.clan_ids)
+        competitors = rng.sample([clan_id for clan_id in fake_map.clan_ids if clan_id != self.owner_id],
+                                 min(competitors_count, len(fake_map.clan_ids) - 1))
+        self.clan_ids = competitors + [self.owner_id]
+
+        # rounds: [[(clan_a, clan_b, winner)]], the last one is battle with owner
+        self.rounds = []
+        while len(competitors) > 1:
+            battles = [
+                (clan_a, clan_b, rng.choice([clan_a, clan_b]))
+                for clan_a, clan_b in zip(competitors[::2], competitors[1::2])
+            ]
+            self.rounds.append(battles)
+            competitors = [winner for clan_a, clan_b, winner in battles] + competitors[len(battles) * 2:]
+        if competitors:
+            self.rounds.append([(competitors[0], self.owner_id, rng.choice([competitors[0], self.owner_id]))])
+        self.winner_id = self.rounds[-1][0][2] if self.rounds else self.owner_id
+
+    def round_start_at(self, round_number):
+        return self.start_at + timedelta(seconds=(round_number - 1) * self.map.round_seconds)
+
+    def current_round(self, now):
+        """Number of running round, 0 before start, len(rounds) + 1 after finish"""
+        if now < self.start_at:
+            return 0
+        return min(int((now - self.start_at).total_seconds() // self.map.round_seconds) + 1, len(self.rounds) + 1)
+
+    def owner_at(self, now):
+        return self.winner_id if self.current_round(now) > len(self.rounds) else self.owner_id
+
+    def remaining(self, round_number):
+        """Competitors taking part in round"""
+        return [clan_id for battle in self.rounds[round_number - 1] for clan_id in battle[:2]
+                if clan_id != self.owner_id]
+
+    def battle_json(self, round_number, clan_a, clan_b):
+        return {
+            'battle_reward': None, 'round': round_number,
+            'start_at': self.round_start_at(round_number).strftime(wg_datetime_format),
+            'clan_a': {'clan_id': clan_a, 'battle_reward': 0, 'loose_elo_delta': -10, 'win_elo_delta': 5},
+            'clan_b': {'clan_id': clan_b, 'battle_reward': 0, 'loose_elo_delta': -10, 'win_elo_delta': 5},
+        }
+
+    def province_data(self, now):
+        round_number = self.current_round(now)
+        data = {
+            'province_id': self.province_id, 'province_name': self.province_name,
+            'front_id': self.map.front_id(self.index), 'owner_clan_id': self.owner_at(now),
+            'arena_id': self.arena_id, 'arena_name': self.arena_name, 'server': 'RU1',
+            'prime_time': self.prime_time, 'landing_type': 'tournament',
+            'battles_start_at': self.start_at.strftime(wg_datetime_format),
+            'round_number': max(round_number, 1), 'competitors': [], 'attackers': [], 'active_battles': [],
+            'status': None,
+        }
+        if round_number == 0:
+            data['attackers'] = [clan_id for clan_id in self.clan_ids if clan_id != self.owner_id]
+        elif round_number <= len(self.rounds):
+            data['status'] = 'STARTED'
+            data['competitors'] = self.remaining(round_number)
+            data['active_battles'] = [
+                self.battle_json(round_number, clan_a, clan_b)
+                for clan_a, clan_b, winner in self.rounds[round_number - 1]
+            ]
+        else:
+            data['status'] = 'FINISHED'
+            data['round_number'] = len(self.rounds)
+        return data
+
+    def tournament_info(self, now):
+        round_number = self.current_round(now)
+        if round_number == 0:
+            pretenders = [clan_id for clan_id in self.clan_ids if clan_id != self.owner_id]
+        elif round_number <= len(self.rounds):
+            pretenders = self.remaining(round_number)
+        else:
+            pretenders = []
+        battles = []
+        if 0 < round_number <= len(self.rounds):
+            battles = [
+                {'first_competitor': self.map.clan(clan_a), 'second_competitor': self.map.clan(clan_b)}
+                for clan_a, clan_b, winner in self.rounds[round_number - 1]
+            ]
+        return {
+            'province_id': self.province_id, 'province_name': self.province_name,
+            'front_id': self.map.front_id(self.index), 'arena_name': self.arena_name,
+            'owner': self.map.clan(self.owner_at(now)), 'pretenders': [self.map.clan(i) for i in pretenders],
+            'battles': battles, 'round_number': max(round_number, 1), 'is_superfinal': False,
+            'start_time': self.start_at.strftime('%H:%M:%S'),
+        }
+
+    def clan_state(self, clan_id, now):
+        """'battle' if clan fights now, 'planned' if clan still takes part, None otherwise"""
+        round_number = self.current_round(now)
+        if round_number > len(self.rounds):
+            return None
+        if round_number == 0:
+            return 'planned'
+        if any(clan_id in battle[:2] for battle in self.rounds[round_number - 1]):
+            return 'battle'
+        return None
+
+    def log_entries(self, clan_id, now):
+        entries = []
+        for round_number, battles in enumerate(self.rounds, 1):
+            # battle result is known a third of round after its start
+            created_at = self.round_start_at(round_number) + timedelta(seconds=self.map.round_seconds // 3)
+            if created_at > now:
+                break
+            for clan_a, clan_b, winner_id in battles:
+                if clan_id not in (clan_a, clan_b):
+                    continue
+                enemy_id = clan_b if clan_id == clan_a else clan_a
+                entries.append({
+                    'created_at': created_at.strftime(log_datetime_format),
+                    'type': 'TOURNAMENT_BATTLE_WON' if winner_id == clan_id else 'TOURNAMENT_BATTLE_LOST',
+                    'target_province': {'alias': self.province_id, 'name': self.province_name},
+                    'enemy_clan': {'id': enemy_id, 'tag': self.map.clan(enemy_id)['tag']},
+                    'winner_id': winner_id,
+                })
+        return entries
+
+
+class FakeApiServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, fake_map, latency=0.0, jitter=0.0, error_rate=0.0, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, FakeApiHandler)
+        self.map = fake_map
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.verbose = verbose
+        self.random = random.Random()
+
+    def wg_api_routes(self):
+        return {
+            'wot/globalmap/info': self.map.globalmap_info,
+            'wot/globalmap/fronts': self.map.globalmap_fronts,
+            'wot/globalmap/provinces': self.map.globalmap_provinces,
+            'wot/globalmap/clanprovinces': self.map.globalmap_clanprovinces,
+            'wot/account/info': self.map.account_info,
+            'wgn/clans/info': self.map.clans_info,
+            'wgn/clans/list': self.map.clans_list,
+        }
+
+    def game_api_routes(self):
+        return {
+            'tournament_info': self.map.tournament_info,
+            'province_info': self.map.province_info,
+            'wot/clan_tactical_data': lambda params, now: {'data': []},
+        }
+
+
+class FakeApiHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, as the importer uses pooled connections
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            logger.info("%s - %s", self.address_string(), format % args)
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        params = dict(parse_qsl(url.query))
+        path = url.path.strip('/')
+        now = datetime.now(tz=pytz.UTC)
+
+        delay = server.latency + server.random.uniform(0, server.jitter)
+        if delay:
+            time.sleep(delay)
+        fail = server.error_rate and server.random.random() < server.error_rate
+
+        if path.startswith('wgapi/'):
+            self.handle_wg_api(path[len('wgapi/'):], params, now, fail)
+        elif path.startswith('game_api/'):
+            self.handle_game_api(path[len('game_api/'):], params, now, fail)
+        else:
+            self.send_json({'error': 'NOT_FOUND'}, status=404)
+
+    def handle_wg_api(self, method, params, now, fail):
+        route = self.server.wg_api_routes().get(method)
+        if fail:
+            code, message = self.server.random.choice([(407, 'REQUEST_LIMIT_EXCEEDED'), (504, 'SOURCE_NOT_AVAILABLE')])
+            error = {'code': code, 'message': message, 'field': None, 'value': None}
+            return self.send_json({'status': 'error', 'error': error})
+        if route is None:
+            error = {'code': 404, 'message': 'METHOD_NOT_FOUND', 'field': None, 'value': None}
+            return self.send_json({'status': 'error', 'error': error})
+        try:
+            data = route(params, now)
+        except ApiError as e:
+            error = {'code': e.code, 'message': e.message, 'field': None, 'value': None}
+            return self.send_json({'status': 'error', 'error': error})
+        count = len(data) if isinstance(data, (list, dict)) else None
+        self.send_json({'status': 'ok', 'meta': {'count': count}, 'data': data})
+
+    def handle_game_api(self, path, params, now, fail):
+        if fail:
+            return self.send_json({'error': 'SERVICE_UNAVAILABLE'}, status=503)
+        match = re.match(r'^clan/(\d+)/(battles|log)$', path)
+        try:
+            if match:
+                clan_id, method = int(match.group(1)), match.group(2)
+                handler = self.server.map.clan_battles if method == 'battles' else self.server.map.clan_log
+                data = handler(clan_id, params, now)
+            elif path in self.server.game_api_routes():
+                data = self.server.game_api_routes()[path](params, now)
+            else:
+                return self.send_json({'error': 'NOT_FOUND'}, status=404)
+        except ApiError as e:
+            return self.send_json({'error': e.message}, status=e.http_status)
+        self.send_json(data)
+
+
+class Command(BaseCommand):
+    help = 'Run local stand-in of WG API and global map game API with generated evolving tournaments'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8800)
+        parser.add_argument('--fronts', type=int, default=2)
+        parser.add_argument('--provinces', type=int, default=200)
+        parser.add_argument('--clans', type=int, default=300)
+        parser.add_argument('--round-seconds', type=int, default=60,
+                            help='Duration of a tournament round, a map day lasts %s rounds' % rounds_per_day)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--latency', type=float, default=0.05, help='Seconds added to every response')
+        parser.add_argument('--jitter', type=float, default=0.05, help='Max random seconds added to latency')
+        parser.add_argument('--error-rate', type=float, default=0.0,
+                            help='Fraction of requests answered with rate limit or 5xx errors')
+
+    def handle(self, *args, **options):
+        fake_map = FakeMap(
+            fronts=options['fronts'], provinces=options['provinces'], clans=options['clans'],
+            round_seconds=options['round_seconds'], seed=options['seed'],
+        )
+        server = FakeApiServer(
+            (options['host'], options['port']), fake_map, latency=options['latency'], jitter=options['jitter'],
+            error_rate=options['error_rate'], verbose=options['verbosity'] > 1,
+        )
+        base_url = 'http://%s:%s/' % (options['host'], options['port'])
+        self.stdout.write('Serving WG API at %swgapi/ and game API at %sgame_api/, clans %s..%s' % (
+            base_url, base_url, fake_map.clan_ids[0], fake_map.clan_ids[-1]))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -1,26 +1,63 @@
 # coding=utf-8
-from django.conf import settings
+from django.db import close_old_connections, connection, connections, transaction
 from django.db.models import Q
 from datetime import datetime, timedelta, time
 import pytz
 from django.core.management.base import BaseCommand, CommandError
 from django.core.mail import mail_admins
+from django.conf import settings
 
-from collections import defaultdict
+from collections import Counter, defaultdict, namedtuple
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from time import sleep
+import hashlib
 import json
-import requests
-import wargaming
+import math
+import threading
 import logging
 
 from wargaming.exceptions import RequestError
 
-from global_map.models import Front, Clan, Province, ProvinceAssault, ProvinceBattle, ClanArenaStat
+from global_map import data_version, game_api, metrics, push, work_queue
+from global_map.models import Front, Clan, Province, ProvinceAssault, ProvinceBattle, ClanArenaStat, \
+    ProvinceChange, RefreshJob, get_or_create_clans, clan_resolver, wot
 
-wot = wargaming.WoT(settings.WARGAMING_KEY, language='ru', region='ru')
 logger = logging.getLogger(__name__)
 
 day_begin_time = time(3, 0)  # battle day starts at 06:00 MSK(UTC+3)
 
+# fields of wot.globalmap.provinces data which are stored by update_province
+province_digest_fields = (
+    'province_id', 'province_name', 'owner_clan_id', 'arena_id', 'arena_name', 'server', 'prime_time',
+    'competitors', 'attackers', 'landing_type', 'round_number', 'active_battles', 'status', 'battles_start_at',
+)
+
+crawl_page_size = 100  # max limit of wot.globalmap.provinces
+
+idle_job_priority = 24 * 60 * 60  # priority of jobs without planned battles
+
+battle_log_page_size = 100
+battle_log_max_entries = 3000  # limit for clans which log was never processed
+# entries older than the cursor which are read again, so battles imported by the next run after their
+# results were logged still get winners: sparse interval of the daemon (10 minutes) and a margin
+battle_log_overlap = timedelta(minutes=15)
+battle_result_types = (
+    'SUPER_FINAL_BATTLE_LOST',
+    'SUPER_FINAL_BATTLE_WON',
+    'TOURNAMENT_BATTLE_FINISHED_WITH_DRAW',
+    'TOURNAMENT_BATTLE_LOST',
+    'TOURNAMENT_BATTLE_WON',
+)
+
+# battle result from clan log
+BattleResult = namedtuple('BattleResult', ['province_id', 'created_at', 'enemy_id', 'winner_id'])
+
+# Clans are imported concurrently with --workers, but several clans can touch
+# the same provinces, so all DB writes of the import are serialized on this
+# lock while network calls of different clans overlap.
+db_lock = threading.RLock()
+
 
 def utc_now():
     return datetime.now(tz=pytz.UTC)
@@ -29,7 +66,7 @@ def utc_now():
 class ProvinceInfo(dict):
     def __init__(self, province_id, seq=None, **kwargs):
         super(ProvinceInfo, self).__init__(self, seq=seq, **kwargs)
-        resp = requests.get('https://ru.wargaming.net/globalmap/game_api/province_info?alias=%s' % province_id).json()
+        resp = game_api.get_json('province_info', params={'alias': province_id})
         self.update({
             # 'arena_id', => NO INFO
             'arena_name': resp['province']['arena_name'],
@@ -49,11 +86,94 @@ class ProvinceInfo(dict):
         })
 
 
+def upsert_battles(assault, province, arena_id, active_battles):
+    """Insert or update all active battles of assault with one statement
+
+    Returns list of (battle_id, round, clan_a_id, clan_b_id, old_start_at, start_at)
+    of created battles and battles with changed start_at, old_start_at is None
+    for created ones.
+    """
+    rows = {}
+    for active_battle in active_battles:
+        # WG return different time for same battle, that is why start_at
+        # can be updated.
+        key = (active_battle['round'], active_battle['clan_a']['clan_id'], active_battle['clan_b']['clan_id'])
+        rows[key] = datetime.strptime(active_battle['start_at'], '%Y-%m-%dT%H:%M:%S').replace(tzinfo=pytz.UTC)
+    if not rows:
+        return []
+
+    params = []
+    for (round_number, clan_a_id, clan_b_id), start_at in rows.items():
+        params.extend([assault.pk, province.pk, arena_id, clan_a_id, clan_b_id, round_number, start_at])
+    with connection.cursor() as cursor:
+        # "old" is read from the snapshot taken before the insert
+        cursor.execute(
+            'WITH old AS (SELECT id, start_at FROM {table} WHERE assault_id = %s), '
+            'upserted AS ('
+            '  INSERT INTO {table} (assault_id, province_id, arena_id, clan_a_id, clan_b_id, round, start_at) '
+            '  VALUES {values} '
+            '  ON CONFLICT (assault_id, round, clan_a_id, clan_b_id) DO UPDATE '
+            '  SET province_id = EXCLUDED.province_id, arena_id = EXCLUDED.arena_id, start_at = EXCLUDED.start_at '
+            '  RETURNING id, round, clan_a_id, clan_b_id, start_at'
+            ') '
+            'SELECT upserted.id, round, clan_a_id, clan_b_id, old.start_at, upserted.start_at '
+            'FROM upserted LEFT JOIN old ON old.id = upserted.id '
+            'WHERE old.start_at IS DISTINCT FROM upserted.start_at'.format(
+                table=ProvinceBattle._meta.db_table,
+                values=', '.join(['(%s, %s, %s, %s, %s, %s, %s)'] * len(rows)),
+            ),
+            [assault.pk] + params,
+        )
+        metrics.rows_written.inc(len(rows), table='province_battle')
+        return cursor.fetchall()
+
+
+def province_data_digest(province_data):
+    """Digest of province data fields used by update_province"""
+    data = {field: province_data[field] for field in province_digest_fields}
+    return hashlib.sha1(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+
 def update_province(province, province_data):
+    """Update province from wot.globalmap.provinces data
+
+    Returns False if data is the same as on the previous update and province
+    was left untouched.
+    """
+    digest = province_data_digest(province_data)
+    if province.data_digest == digest:
+        logger.debug("update_province: province '%s' did not change", province_data['province_id'])
+        return False
+
+    changes = []
+    touched = set()
+    complete = apply_province_data(province, province_data, changes, touched)
+    transaction.on_commit(lambda: data_version.bump(touched))
+    changes = [change for change in changes if change is not None]
+    if changes:
+        ProvinceChange.objects.bulk_create(changes)
+        metrics.rows_written.inc(len(changes), table='province_change')
+        push.publish(touched, changes)
+    if complete:
+        Province.objects.filter(pk=province.pk).update(data_digest=digest)
+        province.data_digest = digest
+    return True
+
+
+def apply_province_data(province, province_data, changes=None, touched=None):
+    """Returns False if result depends on something besides province_data
+
+    ProvinceChange events (or None for unchanged values) are appended to
+    changes, (clan_id, date) of schedules which could change are added to
+    touched.
+    """
+    if changes is None:
+        changes = []
+    if touched is None:
+        touched = set()
     province_id = province_data['province_id']
     province_name = province_data['province_name']
-    province_owner = province_data['owner_clan_id'] and \
-                     Clan.objects.get_or_create(pk=province_data['owner_clan_id'])[0]
+    owner_clan_id = province_data['owner_clan_id']
     arena_id = province_data['arena_id']
     arena_name = province_data['arena_name']
     server = province_data['server']
@@ -70,6 +190,25 @@ def update_province(province, province_data):
 
     logger.debug("update_province: running update for province '%s'", province_id)
 
+    battle_clan_ids = [
+        active_battle[side]['clan_id']
+        for active_battle in active_battles
+        for side in ('clan_a', 'clan_b')
+    ]
+    assault_clan_ids = competitors + attackers
+    complete = True
+    if status == 'STARTED' and not assault_clan_ids:
+        # BUG in WG API: it returns empty list in 'competitors' or 'attackers'
+        # could happen after start of prime time
+        assault_clan_ids = battle_clan_ids + list(province.tournament_info.pretenders)
+        complete = False
+
+    # all clans of province are fetched or created at once
+    all_clans = get_or_create_clans(assault_clan_ids + battle_clan_ids + ([owner_clan_id] if owner_clan_id else []))
+    province_owner = owner_clan_id and all_clans[owner_clan_id]
+
+    changes.append(ProvinceChange.diff(province, ProvinceChange.FIELD_OWNER,
+                                       province.province_owner_id, owner_clan_id or None))
     province.province_name = province_name
     province.province_owner = province_owner
     province.arena_id = arena_id
@@ -78,21 +217,7 @@ def update_province(province, province_data):
     province.prime_time = time(*map(int, prime_time.split(':')))  # UTC time
     province.save()
 
-    clans = {
-        clan_id: Clan.objects.get_or_create(pk=clan_id)[0]
-        for clan_id in competitors + attackers
-    }
-
-    if status == 'STARTED' and not clans:
-        # BUG in WG API: it returns empty list in 'competitors' or 'attackers'
-        # could happen after start of prime time
-        for active_battle in active_battles:
-            clan_a_id = active_battle['clan_a']['clan_id']
-            clan_b_id = active_battle['clan_b']['clan_id']
-            clans[clan_a_id] = Clan.objects.get_or_create(pk=clan_a_id)[0]
-            clans[clan_b_id] = Clan.objects.get_or_create(pk=clan_b_id)[0]
-        for clan in province.tournament_info.pretenders:
-            clans[clan['id']] = Clan.objects.get_or_create(pk=clan['id'])[0]
+    clans = {clan_id: all_clans[clan_id] for clan_id in assault_clan_ids}
 
     dt = battles_start_at
     today_start = battles_start_at.replace(
@@ -104,6 +229,7 @@ def update_province(province, province_data):
 
     # if battle starts next day, but belongs to previous
     date = dt.date() if dt >= today_start else (dt - timedelta(days=1)).date()
+    touched.update((clan_id, date) for clan_id in all_clans)
     try:
         assault = ProvinceAssault.objects.get(province=province, date=date)
     except ProvinceAssault.DoesNotExist:
@@ -121,6 +247,7 @@ def update_province(province, province_data):
                 round_number=round_number,
                 status=status,
             )
+            changes.append(ProvinceChange.diff(province, ProvinceChange.FIELD_ROUND_NUMBER, None, round_number))
             logger.debug("created assault for '%s' {current_owner: '%s', date: '%s', 'attackers_count': %s}",
                          province_id, province.province_owner, date, len(province_data['attackers']))
         else:
@@ -128,6 +255,8 @@ def update_province(province, province_data):
             assault.prime_time = province.prime_time
             assault.arena_id = province.arena_id
             assault.landing_type = landing_type
+            changes.append(ProvinceChange.diff(province, ProvinceChange.FIELD_ROUND_NUMBER,
+                                               assault.round_number, round_number))
             assault.round_number = round_number
             assault.status = status
             assault.save()
@@ -144,38 +273,31 @@ def update_province(province, province_data):
             mail_admins('Update finished Assault for %s' % province_id,
                         json.dumps(province_data, sort_keys=True, indent=4))
             logger.error("Status FINISHED for province attack on running assault, do not update assault")
-            return
-
-        for active_battle in active_battles:
-            # WG return different time for same battle, that is why start_at
-            # can be updated.
-            clan_a_id = active_battle['clan_a']['clan_id']
-            clan_b_id = active_battle['clan_b']['clan_id']
-            clan_a = clans[clan_a_id] if clan_a_id in clans else Clan.objects.get_or_create(pk=clan_a_id)[0]
-            clan_b = clans[clan_b_id] if clan_b_id in clans else Clan.objects.get_or_create(pk=clan_b_id)[0]
+            return False
 
-            pb, created = ProvinceBattle.objects.update_or_create(
-                assault=assault,
-                province=province,
-                arena_id=arena_id,
-                clan_a=clan_a,
-                clan_b=clan_b,
-                round=active_battle['round'],
-                defaults={
-                    'start_at': datetime.strptime(
-                        active_battle['start_at'], '%Y-%m-%dT%H:%M:%S').replace(tzinfo=pytz.UTC)
-                }
-            )
-            if created:
+        for battle_id, battle_round, clan_a_id, clan_b_id, old_start_at, start_at in \
+                upsert_battles(assault, province, arena_id, active_battles):
+            if old_start_at is None:
+                changes.append(ProvinceChange.diff(province, ProvinceChange.FIELD_BATTLE, None, start_at,
+                                                   battle_id=battle_id))
                 logger.debug("created battle for '%s' {round: '%s', clan_a: '%s', clan_b '%s'}",
-                             province_id, pb.round, repr(pb.clan_a), repr(pb.clan_b))
+                             province_id, battle_round, repr(all_clans[clan_a_id]), repr(all_clans[clan_b_id]))
+            else:
+                changes.append(ProvinceChange.diff(province, ProvinceChange.FIELD_BATTLE_START_AT,
+                                                   old_start_at, start_at, battle_id=battle_id))
 
         # if owner in attackers/competitors list
         # it can happen if we're filling assaulting clans from battles
         if assault.current_owner and assault.current_owner.id in clans:
             del clans[assault.current_owner.id]
 
-        if set(assault.clans.all()) != set(clans.values()):
+        assault_clans = set(assault.clans.all())
+        touched.update((c.id, date) for c in assault_clans)
+        if assault.current_owner_id:
+            touched.add((assault.current_owner_id, date))
+        if assault_clans != set(clans.values()):
+            changes.append(ProvinceChange.diff(province, ProvinceChange.FIELD_ATTACKERS,
+                                               [c.id for c in assault_clans], clans.keys()))
             assault.clans.clear()
             if clans:
                 assault.clans.add(*clans.values())
@@ -189,126 +311,221 @@ def update_province(province, province_data):
                 else:
                     logger.warn("no clans left in assault %s after its prime time", province_id)
 
+    return complete
+
 
 def collect_clan_related_provinces(clan):
     provinces = []
+    related = []
 
     # fetch clan battles
     try:
         clan_provinces = wot.globalmap.clanprovinces(clan_id=clan.id, language='ru')[str(clan.id)]
         if clan_provinces:
-            for p in clan_provinces:
-                provinces.append(Province.objects.get_or_create(
-                    province_id=p['province_id'], front=Front.objects.get(front_id=p['front_id']))[0])
+            related.extend((p['province_id'], p['front_id']) for p in clan_provinces)
     except RequestError as e:
         logger.error("Import error wot.globalmap.clanprovinces returned %s (%s)",
                      e.code, e.message)
 
     # poll unofficial WG API
-    data = requests.get('https://ru.wargaming.net/globalmap/game_api/clan/%s/battles' % clan.id).json()
-    for p in data['battles'] + data['planned_battles']:
-        provinces.append(Province.objects.get_or_create(
-                    province_id=p['province_id'], front=Front.objects.get(front_id=p['front_id']))[0])
-
-    # fetch existing ProvinceAssault
-    now = datetime.now(tz=pytz.UTC)
-    for pa in ProvinceAssault.objects.order_by('province', '-date').distinct('province'):
-        if clan in pa.clans.all() or pa.current_owner == clan:
-            if pa.datetime >= now:  # battle is planned
-                provinces.append(pa.province)
-            elif pa.datetime + timedelta(hours=6) >= now:  # battle is running
-                provinces.append(pa.province)
+    data = game_api.get_json('clan/%s/battles' % clan.id)
+    related.extend((p['province_id'], p['front_id']) for p in data['battles'] + data['planned_battles'])
+
+    with db_lock:
+        for province_id, front_id in related:
+            front = front_registry.get(front_id)
+            province = Province.objects.get_or_create(province_id=province_id, front=front)[0]
+            province.front = front
+            provinces.append(province)
+
+        # fetch existing ProvinceAssault
+        provinces.extend(pa.province for pa in active_clan_assaults(clan, utc_now()))
 
     return list(set(provinces))
 
 
-def get_provinces_data(provinces):
+def active_clan_assaults(clan, now):
+    """Planned or running (started less than 6 hours ago) assaults where clan attacks or defends"""
+    since = now - timedelta(hours=6)
+    return ProvinceAssault.objects \
+        .filter(date__gte=(since - timedelta(days=1)).date()) \
+        .extra(where=['(global_map_provinceassault.date + global_map_provinceassault.prime_time) >= %s'],
+               params=[since.astimezone(pytz.UTC).replace(tzinfo=None)]) \
+        .filter(Q(clans=clan) | Q(current_owner=clan)) \
+        .select_related('province__front') \
+        .distinct()
+
+
+def fetch_provinces_batch(batch):
+    front_id, province_ids = batch
+    try:
+        return list(wot.globalmap.provinces(front_id=front_id, province_id=','.join(province_ids)))
+    except RequestError as e:
+        logger.error("Import error wot.globalmap.provinces returned %s (%s), skip", e.code, e.message)
+        return []
+
+
+def get_provinces_data(provinces, workers=1):
     provinces_data = {}
     map_id_model = {}
     fronts = defaultdict(list)
 
-    # map province_id to province model
+    # map (front_id, province_id) to province model
     for province in provinces:
-        map_id_model[province.province_id] = province
+        map_id_model[(province.front.front_id, province.province_id)] = province
 
     # group by front_id
-    for province in provinces:
-        fronts[province.front.front_id].append(str(province.province_id))
+    for front_id, province_id in map_id_model:
+        fronts[front_id].append(str(province_id))
+
+    # every front is requested by batches of 100 provinces
+    batches = [
+        (front_id, front_provinces[i:i+100])
+        for front_id, front_provinces in fronts.items()
+        for i in range(0, len(front_provinces), 100)
+    ]
 
     # fetch data
-    for front_id, front_provinces in fronts.items():
-        province_ids = [','.join(front_provinces[i:i+100]) for i in range(0, len(front_provinces), 100)]
-        for province_id in province_ids:
-            try:
-                result_list = wot.globalmap.provinces(front_id=front_id, province_id=province_id)
-            except RequestError as e:
-                logger.error("Import error wot.globalmap.provinces returned %s (%s), skip", e.code, e.message)
-            else:
-                for data in result_list:
-                    province_id = data['province_id']
-                    provinces_data[map_id_model[province_id]] = data
+    with metrics.stage('province_fetch'):
+        results = map_concurrently(fetch_provinces_batch, batches, workers)
+    for result_list in results:
+        for data in result_list:
+            provinces_data[map_id_model[(data['front_id'], data['province_id'])]] = data
 
     return provinces_data
 
 
+def parse_log_datetime(value):
+    return datetime.strptime(value[0:19], '%Y-%m-%d %H:%M:%S').replace(tzinfo=pytz.UTC)
+
+
+def fetch_battle_log(clan):
+    """Fetch battle results from clan log created since the last processed entry
+
+    Log is paged from the newest entries, paging stops at entries older than
+    battle_log_overlap before the last processed one. Overlapping entries
+    are fetched again for battles imported after their results were logged,
+    they are harmless to re-apply since only battles without winner match.
+    Response bodies are parsed as a stream and only BattleResult tuples are
+    kept. Returns (results, created_at of the newest entry).
+    """
+    results = []
+    newest = None
+    since = clan.battle_log_synced_at - battle_log_overlap if clan.battle_log_synced_at else None
+    for page_number in range(1, battle_log_max_entries // battle_log_page_size + 1):
+        entries_count = 0
+        for log in game_api.iter_json_items('clan/%s/log' % clan.id, 'data', params={
+                'category': 'battles', 'page_number': page_number, 'page_size': battle_log_page_size}):
+            entries_count += 1
+            created_at = parse_log_datetime(log['created_at'])
+            if newest is None:
+                newest = created_at
+            if since and created_at < since:
+                return results, newest
+            if log['type'] in battle_result_types:
+                results.append(BattleResult(
+                    log['target_province']['alias'], created_at, log['enemy_clan']['id'], log['winner_id']))
+        if entries_count < battle_log_page_size:
+            break
+    return results, newest
+
+
 def update_winners_from_log(clan):
-    resp = requests.get('https://ru.wargaming.net/globalmap/game_api/clan/%s/log?'
-                        'category=battles&page_number=1&page_size=3000' % clan.id).json()['data']
+    results, newest = fetch_battle_log(clan)
+    logger.debug("Clan %s has %s new battle results", repr(clan), len(results))
+    if newest is None:
+        return
+    with db_lock:
+        apply_battle_log(clan, results)
+        Clan.objects.filter(pk=clan.pk).update(battle_log_synced_at=newest)
+
 
+def apply_battle_log(clan, results):
     logs = defaultdict(list)
-    battle_result_types = [
-        'SUPER_FINAL_BATTLE_LOST',
-        'SUPER_FINAL_BATTLE_WON',
-        'TOURNAMENT_BATTLE_FINISHED_WITH_DRAW',
-        'TOURNAMENT_BATTLE_LOST',
-        'TOURNAMENT_BATTLE_WON',
-    ]
-    for log in resp:
-        if log['type'] in battle_result_types:
-            province_id = log['target_province']['alias']
-            log['created_at'] = datetime.strptime(log['created_at'][0:19], '%Y-%m-%d %H:%M:%S').replace(tzinfo=pytz.UTC)
-            log['enemy_clan'] = Clan.objects.get_or_create(pk=log['enemy_clan']['id'])[0]
-            logs[province_id].insert(0, log)
+    for result in results:
+        logs[result.province_id].append(result)
+    for province_logs in logs.values():
+        province_logs.sort(key=lambda result: result.created_at)
+    get_or_create_clans(result.enemy_id for result in results)
 
     province_battles = defaultdict(list)
     for pb in ProvinceBattle.objects.filter(winner=None).filter(Q(clan_a=clan) | Q(clan_b=clan)).order_by('start_at') \
-            .select_related('province'):
+            .select_related('province', 'assault'):
         province_battles[pb.province.province_id].append(pb)
 
-    for province_id in province_battles.keys():
-        pb_index = log_index = 0
-        total_pb = len(province_battles[province_id])
-        total_logs = len(logs[province_id])
-        while True:
-            if pb_index >= total_pb or log_index >= total_logs:
-                break
+    winners = {}
+    touched = set()
+    changes = []
+    for province_id, battles in province_battles.items():
+        for pb, winner_id in match_winners(battles, logs[province_id]):
+            if winner_id:
+                winners[pb.pk] = winner_id
+                touched.update([(pb.clan_a_id, pb.assault.date), (pb.clan_b_id, pb.assault.date)])
+                changes.append(ProvinceChange.diff(pb.province, ProvinceChange.FIELD_WINNER, None, winner_id,
+                                                   battle_id=pb.pk))
 
-            pb = province_battles[province_id][pb_index]
-            log = logs[province_id][log_index]
+    if winners:
+        get_or_create_clans(winners.values())
+        set_battle_winners(winners)
+        ProvinceChange.objects.bulk_create(changes)
+        metrics.rows_written.inc(len(changes), table='province_change')
+        push.publish(touched, changes)
+        transaction.on_commit(lambda: data_version.bump(touched))
+        logger.debug("Clan %s: set winners for %s battles", repr(clan), len(winners))
 
-            start_at = pb.start_at
-            result_at = log['created_at']
 
-            if start_at > result_at:  # result earlier than battle started
-                log_index += 1
-                continue
-            # match if -5 ... 20 from battle start time
-            # for example if battle starts at 17:00 it would be matched by result 16:55 ... 17:20
-            if result_at + timedelta(minutes=5) >= start_at >= result_at - timedelta(minutes=20):
-                pb.winner = Clan.objects.get_or_create(pk=log['winner_id'])[0]
-                pb.save()
-                pb_index += 1
-                log_index += 1
-                continue
-            if result_at > start_at + timedelta(minutes=20):
-                pb_index += 1
+def match_winners(battles, logs):
+    """Match battles of one province to battle results from clan log
+
+    Both battles and logs (BattleResult tuples) must be sorted by time. Returns list of
+    (battle, winner_id) pairs.
+    """
+    matches = []
+    pb_index = log_index = 0
+    while pb_index < len(battles) and log_index < len(logs):
+        pb = battles[pb_index]
+        log = logs[log_index]
+
+        start_at = pb.start_at
+        result_at = log.created_at
+
+        if start_at > result_at:  # result earlier than battle started
+            log_index += 1
+            continue
+        # match if -5 ... 20 from battle start time
+        # for example if battle starts at 17:00 it would be matched by result 16:55 ... 17:20
+        if result_at + timedelta(minutes=5) >= start_at >= result_at - timedelta(minutes=20):
+            matches.append((pb, log.winner_id))
+            pb_index += 1
+            log_index += 1
+            continue
+        if result_at > start_at + timedelta(minutes=20):
+            pb_index += 1
+    return matches
+
+
+def set_battle_winners(winners):
+    """Set winners {battle_id: winner_id} with one statement"""
+    params = []
+    for battle_id, winner_id in winners.items():
+        params.extend([battle_id, winner_id])
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'UPDATE {table} AS pb SET winner_id = v.winner_id '
+            'FROM (VALUES {values}) AS v (id, winner_id) WHERE pb.id = v.id'.format(
+                table=ProvinceBattle._meta.db_table,
+                values=', '.join(['(%s, %s)'] * len(winners)),
+            ),
+            params,
+        )
+    metrics.rows_written.inc(len(winners), table='province_battle')
 
 
 def update_tactical_data(clan):
     if clan.extra.globalmap_cookie:
-        data = requests.get('https://ru.wargaming.net/globalmap/game_api/wot/clan_tactical_data', headers={
+        data = game_api.get_json('wot/clan_tactical_data', headers={
             'cookie': clan.extra.globalmap_cookie,
-        }).json()['data']
+        })['data']
         for province_data in data:
             division = province_data['division']
             if division:
@@ -321,59 +538,490 @@ def update_tactical_data(clan):
 
 
 
-def update_clan(clan_id):
-    clan = Clan.objects.get_or_create(pk=clan_id)[0]
-    province_ids = {}
-    fronts = {}
-
-    # check global map status
-    globalmap_info = wot.globalmap.info()
-    if globalmap_info['state'] == 'frozen':
-        logger.info("Map is frozen, skipping update")
-        return
+def map_concurrently(func, items, workers=1):
+    """Run func for every item, on a thread pool if more than one worker is requested"""
+    workers = min(max(workers, 1), len(items))
+    if workers == 1:
+        return [func(item) for item in items]
 
-    # fill fronts info
+    stage = metrics.current_stage()
+
+    def run_in_thread(item):
+        try:
+            with metrics.in_stage(stage):
+                return func(item)
+        finally:
+            # every worker thread gets its own DB connection, do not leak them
+            connection.close()
+
+    pool = ThreadPool(workers)
     try:
-        for front in wot.globalmap.fronts():
-            fronts[front['front_id']] = Front.objects.update_or_create(front_id=front['front_id'], defaults={
-                'max_vehicle_level': front['max_vehicle_level'],
-            })[0]
-    except RequestError as e:
-        logger.error("Import error wot.globalmap.fronts returned %s (%s), fallback to DB records",
-                     e.code, e.message)
+        return pool.map(run_in_thread, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def isolated(func):
+    """Log and swallow errors of func, so one failing clan does not break import of others"""
+    def wrapper(item):
+        try:
+            return func(item)
+        except Exception:
+            logger.critical("Unknown error", exc_info=True)
+    return wrapper
+
+
+class FrontRegistry(object):
+    """Global map state and fronts shared by all clans imported by this process
+
+    WG API is asked for map state and fronts at most once per ttl seconds,
+    Front models are kept in memory by front_id.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.map_active = False
+        self.loaded_at = None
+        self.active_front_ids = []
+        self._fronts = {}
+        self._lock = threading.RLock()
+
+    def refresh(self):
+        """Update map state and fronts from WG API, returns False if map is frozen"""
+        with self._lock, metrics.stage('fronts'):
+            self.loaded_at = utc_now()
+
+            # check global map status
+            globalmap_info = wot.globalmap.info()
+            self.map_active = globalmap_info['state'] != 'frozen'
+            if not self.map_active:
+                logger.info("Map is frozen, skipping update")
+                return False
+
+            # fill fronts info
+            try:
+                fronts_data = list(wot.globalmap.fronts())
+            except RequestError as e:
+                logger.error("Import error wot.globalmap.fronts returned %s (%s), fallback to DB records",
+                             e.code, e.message)
+                fronts_data = []
 
-    # split provinces by 100
-    for front_id, provinces in province_ids.items():
-        province_ids[front_id] = [provinces[i:i+100] for i in range(0, len(provinces), 100)]
+            with db_lock:
+                fronts = {front.front_id: front for front in Front.objects.all()}
+                for front_data in fronts_data:
+                    front = fronts.get(front_data['front_id'])
+                    if front is None:
+                        fronts[front_data['front_id']] = Front.objects.create(
+                            front_id=front_data['front_id'], max_vehicle_level=front_data['max_vehicle_level'])
+                    elif front.max_vehicle_level != front_data['max_vehicle_level']:
+                        front.max_vehicle_level = front_data['max_vehicle_level']
+                        front.save()
+            self._fronts = fronts
+            self.active_front_ids = [f['front_id'] for f in fronts_data] or list(fronts)
+            return True
 
-    # Get list of all provinces belonging to clan: defence or attack
-    provinces_list = collect_clan_related_provinces(clan)
-    logger.info('Clan %s related provinces: %s', repr(clan), json.dumps(map(str, provinces_list)))
+    def load(self):
+        """Refresh registry if it is older than ttl, returns False if map is frozen"""
+        with self._lock:
+            if self.loaded_at is None or utc_now() - self.loaded_at > timedelta(seconds=self.ttl):
+                return self.refresh()
+            return self.map_active
 
-    # fetch all provinces data
-    provinces_data = get_provinces_data(provinces_list)
+    def get(self, front_id):
+        front = self._fronts.get(front_id)
+        if front is None:
+            front = self._fronts[front_id] = Front.objects.get(front_id=front_id)
+        return front
 
-    for province, data in provinces_data.items():
-        update_province(province, data)
 
-    update_winners_from_log(clan)
+front_registry = FrontRegistry(ttl=600)
+
+
+def update_provinces(provinces, workers=1):
+    """Fetch provinces from WG API and update them
+
+    Returns Counter of updated, unchanged and failed provinces.
+    """
+    return apply_provinces_data(get_provinces_data(list(provinces), workers))
+
+
+def apply_provinces_data(provinces_data):
+    """Update provinces from {province: data}, returns Counter of updated, unchanged and failed"""
+    stats = Counter()
+    with db_lock, metrics.stage('update_province'):
+        for province, data in provinces_data.items():
+            try:
+                with transaction.atomic():
+                    stats['updated' if update_province(province, data) else 'unchanged'] += 1
+            except Exception:
+                stats['failed'] += 1
+                logger.critical("Failed to update province %s", province.province_id, exc_info=True)
+    for result, count in stats.items():
+        metrics.provinces.inc(count, result=result)
+    return stats
+
+
+def fetch_front_shard(shard):
+    """Fetch pages offset + 1, offset + 1 + stride, ... of front provinces until the last page
+
+    Runs in a crawler process, so it must not touch the DB. Errors stop the
+    shard only, pages fetched before the error are returned and applied.
+    """
+    front_id, offset, stride = shard
+    provinces_data = []
+    page_no = offset + 1
+    while True:
+        try:
+            page = list(wot.globalmap.provinces(front_id=front_id, page_no=page_no, limit=crawl_page_size))
+        except RequestError as e:
+            logger.error("Import error wot.globalmap.provinces front %s page %s returned %s (%s), skip rest of shard",
+                         front_id, page_no, e.code, e.message)
+            break
+        except Exception:
+            logger.critical("Failed to fetch front %s page %s, skip rest of shard", front_id, page_no,
+                            exc_info=True)
+            break
+        provinces_data.extend(page)
+        if len(page) < crawl_page_size:
+            break
+        page_no += stride
+    return front_id, provinces_data
+
+
+def get_or_create_provinces(front, provinces_data):
+    """Returns {province_id: Province} for provinces of front, missing ones are created with one query"""
+    province_ids = [data['province_id'] for data in provinces_data]
+    provinces = {
+        province.province_id: province
+        for province in Province.objects.filter(front=front, province_id__in=province_ids)
+    }
+    new_provinces = [
+        Province(
+            province_id=data['province_id'], front=front, province_name=data['province_name'],
+            arena_id=data['arena_id'], arena_name=data['arena_name'], prime_time=data['prime_time'],
+            server=data['server'],
+        )
+        for data in provinces_data if data['province_id'] not in provinces
+    ]
+    Province.objects.bulk_create(new_provinces)
+    metrics.rows_written.inc(len(new_provinces), table='province')
+    provinces.update((province.province_id, province) for province in new_provinces)
+    for province in provinces.values():
+        province.front = front
+    return provinces
+
+
+def crawl_all_provinces(workers=1):
+    """Update every province of every front
+
+    Fronts are split into shards of pages, which are fetched by a process
+    pool, while this process applies shards as soon as they arrive.
+    Returns provinces stats.
+    """
+    if not front_registry.load():
+        return Counter()
+
+    front_ids = front_registry.active_front_ids
+    workers = max(workers, 1)
+    stride = max(1, int(math.ceil(float(workers) / len(front_ids))))
+    shards = [(front_id, offset, stride) for front_id in front_ids for offset in range(stride)]
+
+    # forked crawlers must not share DB connections of this process
+    connections.close_all()
+    stats = Counter()
+    pool = Pool(workers, initializer=game_api.reset_session)
+    try:
+        for front_id, provinces_data in pool.imap_unordered(fetch_front_shard, shards):
+            try:
+                with db_lock:
+                    provinces = get_or_create_provinces(front_registry.get(front_id), provinces_data)
+            except Exception:
+                stats['failed'] += len(provinces_data)
+                logger.critical("Failed to create provinces of front %s, skip shard", front_id, exc_info=True)
+                continue
+            stats += apply_provinces_data({provinces[data['province_id']]: data for data in provinces_data})
+            logger.info("Front %s: crawled %s provinces", front_id, len(provinces_data))
+    finally:
+        pool.close()
+        pool.join()
+
+    clan_resolver.add_untagged()
+    clan_resolver.resolve()
+    return stats
+
+
+def write_metrics():
+    """Dump metrics of this process to METRICS_TEXTFILE, if it is configured"""
+    if not settings.METRICS_TEXTFILE:
+        return
+    try:
+        metrics.registry.write_textfile(settings.METRICS_TEXTFILE, 'wot_import_')
+    except (IOError, OSError):
+        logger.error("Can't write metrics to %s", settings.METRICS_TEXTFILE, exc_info=True)
+
+
+def log_stats(stats):
+    logger.info("Provinces updated: %s, unchanged: %s, failed: %s",
+                stats['updated'], stats['unchanged'], stats['failed'])
+
+
+def update_clans(clan_ids, workers=1, check_map=True, progress=None):
+    """Import several clans at once
+
+    Provinces related to several clans are fetched from WG API and updated
+    only once per run. Map state and fronts are refreshed when front
+    registry is outdated, check_map=False skips it. progress(stage) is
+    called when the next stage starts. Returns provinces stats.
+    """
+    progress = progress or (lambda stage: None)
+    if check_map and not front_registry.load():
+        return Counter()
+
+    progress('related_provinces')
+    with db_lock:
+        clans = [Clan.objects.get_or_create(pk=clan_id)[0] for clan_id in clan_ids]
+
+    # Get list of all provinces belonging to clans: defence or attack
+    provinces_list = set()
+    with metrics.stage('related_provinces'):
+        related_provinces = map_concurrently(isolated(collect_clan_related_provinces), clans, workers)
+    for clan, clan_provinces in zip(clans, related_provinces):
+        if clan_provinces is None:
+            continue
+        logger.info('Clan %s related provinces: %s', repr(clan), json.dumps([str(p) for p in clan_provinces]))
+        provinces_list.update(clan_provinces)
+
+    progress('provinces')
+    stats = update_provinces(provinces_list, workers)
+
+    progress('winners')
+    with metrics.stage('winners'):
+        map_concurrently(isolated(update_winners_from_log), clans, workers)
     # update_tactical_data(clan)
 
+    # fill tags and titles of all clans met during import and clans added by web processes
+    clan_resolver.add_untagged()
+    clan_resolver.resolve()
+    return stats
+
+
+def update_clan(clan_id):
+    update_clans([clan_id])
+
+
+class AssaultTimeline(object):
+    """Time windows around planned rounds of known assaults
+
+    Every round lasts 30 minutes, province is "hot" from a few minutes
+    before planned round start until the end of the round.
+    """
+    before = timedelta(minutes=5)
+    after = timedelta(minutes=30)
+
+    def __init__(self):
+        self.windows = []
+
+    def rebuild(self, now):
+        windows = []
+        assaults = ProvinceAssault.objects \
+            .filter(date__gte=(now - timedelta(days=1)).date()) \
+            .select_related('province__front', 'current_owner') \
+            .prefetch_related('clans')
+        for assault in assaults:
+            for planned_at in assault.planned_times:
+                if planned_at + self.after >= now:
+                    windows.append((planned_at - self.before, planned_at + self.after, assault.province))
+        self.windows = sorted(windows, key=lambda window: window[0])
+
+    def hot_provinces(self, now):
+        return set(province for start, end, province in self.windows if start <= now <= end)
+
+    def next_start(self, now):
+        for start, end, province in self.windows:
+            if start > now:
+                return start
+
+
+def run_daemon(clan_ids, workers=1, dense_interval=60, sparse_interval=600, global_interval=1800):
+    """Poll WG API forever
+
+    Map state and fronts are refreshed every global_interval. Clans (related
+    provinces discovery and battle log) are refreshed every sparse_interval.
+    Provinces which have a round running or about to start are polled every
+    dense_interval.
+    """
+    timeline = AssaultTimeline()
+    next_global = next_sparse = next_dense = utc_now()
+    map_active = False
+
+    while True:
+        close_old_connections()
+        now = utc_now()
+        try:
+            if now >= next_global:
+                map_active = front_registry.refresh()
+                next_global = now + timedelta(seconds=global_interval)
+
+            if not map_active:
+                next_sparse = next_dense = next_global
+            elif now >= next_sparse:
+                log_stats(update_clans(clan_ids, workers, check_map=False))
+                timeline.rebuild(utc_now())
+                next_sparse = now + timedelta(seconds=sparse_interval)
+                next_dense = now + timedelta(seconds=dense_interval)
+            elif now >= next_dense:
+                hot_provinces = timeline.hot_provinces(now)
+                if hot_provinces:
+                    logger.info("Polling %s provinces in prime time", len(hot_provinces))
+                    log_stats(update_provinces(hot_provinces, workers))
+                    timeline.rebuild(utc_now())
+                next_dense = now + timedelta(seconds=dense_interval)
+        except Exception:
+            logger.critical("Unknown error", exc_info=True)
+
+        # wake up earlier if a round starts before next planned poll
+        wake_at = min(next_global, next_sparse, next_dense)
+        next_round = timeline.next_start(now)
+        if next_round and next_round < wake_at:
+            wake_at = next_dense = next_round
+        write_metrics()
+        sleep(max((wake_at - utc_now()).total_seconds(), 1))
+
+
+def seconds_to_prime_time(assaults, now):
+    """Seconds until the nearest planned round of assaults, 0 if a round is running"""
+    planned_times = [
+        planned_at
+        for assault in assaults
+        for planned_at in assault.planned_times
+        if planned_at + timedelta(minutes=30) >= now
+    ]
+    if not planned_times:
+        return idle_job_priority
+    return max(0, int((min(planned_times) - now).total_seconds()))
+
+
+def enqueue_clans(clan_ids):
+    """Queue refresh of clans, the closer clan battles are the sooner clan is refreshed"""
+    now = utc_now()
+    for clan_id in clan_ids:
+        assaults = active_clan_assaults(Clan(pk=clan_id), now).prefetch_related('clans')
+        job_id = work_queue.enqueue(RefreshJob.KIND_CLAN, clan_id, seconds_to_prime_time(assaults, now))
+        logger.debug("Queued refresh of clan %s, job %s", clan_id, job_id)
+
+
+def enqueue_province(province, now=None):
+    now = now or utc_now()
+    assaults = province.assaults.filter(date__gte=(now - timedelta(days=1)).date()).prefetch_related('clans')
+    return work_queue.enqueue(RefreshJob.KIND_PROVINCE, '%s/%s' % (province.front.front_id, province.province_id),
+                              seconds_to_prime_time(assaults, now))
+
+
+def run_jobs(jobs, workers=1, lease=600):
+    """Run claimed jobs, returns provinces stats
+
+    Lease of jobs is renewed for lease seconds at every stage of the refresh.
+    """
+    clan_ids = [int(job.target) for job in jobs if job.kind == RefreshJob.KIND_CLAN]
+    province_targets = [job.target.split('/', 1) for job in jobs if job.kind == RefreshJob.KIND_PROVINCE]
+
+    stats = Counter()
+    if clan_ids:
+        stats += update_clans(clan_ids, workers, progress=lambda stage: work_queue.set_progress(jobs, stage, lease))
+    if province_targets and front_registry.load():
+        provinces = []
+        for front_id, province_id in province_targets:
+            front = front_registry.get(front_id)
+            province = Province.objects.get(front=front, province_id=province_id)
+            province.front = front
+            provinces.append(province)
+        stats += update_provinces(provinces, workers)
+    return stats
+
+
+def run_queue_worker(workers=1, batch_size=10, lease=600, idle_interval=5):
+    """Consume refresh jobs forever
+
+    Jobs are claimed by batches, so provinces shared by several clans of a
+    batch are updated once.
+    """
+    while True:
+        close_old_connections()
+        try:
+            jobs = work_queue.claim(limit=batch_size, lease=lease)
+        except Exception:
+            logger.critical("Can't claim jobs", exc_info=True)
+            jobs = []
+        if not jobs:
+            sleep(idle_interval)
+            continue
+
+        logger.info("Claimed jobs: %s", ' '.join(repr(job) for job in jobs))
+        try:
+            log_stats(run_jobs(jobs, workers, lease))
+        except Exception as e:
+            logger.critical("Unknown error", exc_info=True)
+            work_queue.fail(jobs, repr(e))
+        else:
+            work_queue.complete(jobs)
+        write_metrics()
+
 
 class Command(BaseCommand):
     help = 'Save map to cache'
 
     def add_arguments(self, parser):
         parser.add_argument('clan_id', nargs='*', type=int)
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Number of concurrent requests to WG API')
+        parser.add_argument('--all-provinces', action='store_true',
+                            help='Crawl every province of every front, --workers sets crawler processes')
+        parser.add_argument('--enqueue', action='store_true',
+                            help='Queue refresh of clans for queue workers instead of updating them')
+        parser.add_argument('--queue-worker', action='store_true',
+                            help='Keep running and process refresh jobs from the queue')
+        parser.add_argument('--batch-size', type=int, default=10,
+                            help='Queue worker: number of jobs claimed at once')
+        parser.add_argument('--daemon', action='store_true',
+                            help='Keep running and poll provinces densely around their prime time')
+        parser.add_argument('--dense-interval', type=int, default=60,
+                            help='Daemon: seconds between polls of provinces in prime time')
+        parser.add_argument('--sparse-interval', type=int, default=600,
+                            help='Daemon: seconds between full updates of clans')
+        parser.add_argument('--global-interval', type=int, default=1800,
+                            help='Daemon: seconds between updates of map state and fronts')
 
     def handle(self, *args, **options):
+        clan_ids = options['clan_id'] or [35039]
+        metrics.count_queries()
+        if options['enqueue']:
+            enqueue_clans(clan_ids)
+            work_queue.cleanup()
+            return
+
+        if options['queue_worker']:
+            logger.info("Starting queue worker %s at %s", work_queue.worker_name(), datetime.now(tz=pytz.UTC))
+            run_queue_worker(options['workers'], options['batch_size'])
+            return
+
+        if options['daemon']:
+            logger.info("Starting import daemon at %s" % datetime.now(tz=pytz.UTC))
+            run_daemon(clan_ids, options['workers'], options['dense_interval'],
+                       options['sparse_interval'], options['global_interval'])
+            return
+
         from time import time
         start = time()
         logger.info("Starting import at %s" % datetime.now(tz=pytz.UTC))
-        for clan_id in options['clan_id'] or [35039]:
-            try:
-                update_clan(clan_id)
-            except Exception:
-                logger.critical("Unknown error", exc_info=True)
+        try:
+            if options['all_provinces']:
+                log_stats(crawl_all_provinces(workers=options['workers']))
+            else:
+                log_stats(update_clans(clan_ids, workers=options['workers']))
+        except Exception:
+            logger.critical("Unknown error", exc_info=True)
         logger.info("Finished import at %s, seconds elapsed %s",
                     datetime.now(tz=pytz.UTC), time() - start)
+        game_api.latency.log_report()
+        write_metrics()
@@ -0,0 +1,163 @@
+"""Server-Sent Events push of import changes to browsers
+
+One thread LISTENs for notifications sent by the importer (see
+global_map/push.py) and fans every notification out to clients subscribed
+to clans it concerns, so an import costs one notification however many
+viewers are watching. Clients connect to /events/?clan_id=<id> through nginx
+with proxy buffering disabled.
+"""
+from __future__ import unicode_literals
+
+from collections import defaultdict
+import json
+import logging
+import select
+import socket
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from six.moves import BaseHTTPServer, queue, socketserver
+from six.moves.urllib.parse import urlparse, parse_qsl
+
+from global_map import push
+
+logger = logging.getLogger(__name__)
+
+keep_alive_interval = 15  # seconds, proxies drop idle connections
+client_queue_size = 100  # slow client is disconnected, it reloads schedule on reconnect
+
+
+class Hub(object):
+    """Subscriptions of connected clients by clan id"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = defaultdict(set)
+
+    def subscribe(self, clan_id):
+        client = queue.Queue(maxsize=client_queue_size)
+        with self._lock:
+            self._subscribers[clan_id].add(client)
+        return client
+
+    def unsubscribe(self, clan_id, client):
+        with self._lock:
+            self._subscribers[clan_id].discard(client)
+            if not self._subscribers[clan_id]:
+                del self._subscribers[clan_id]
+
+    def publish(self, payload):
+        with self._lock:
+            clients = [
+                (clan_id, client) for clan_id in payload['clans'] for client in self._subscribers.get(clan_id, ())
+            ]
+        for clan_id, client in clients:
+            try:
+                client.put_nowait(payload)
+            except queue.Full:
+                # None tells client handler to disconnect
+                self.unsubscribe(clan_id, client)
+                with client.mutex:
+                    client.queue.clear()
+                client.put_nowait(None)
+
+    def listen(self, reconnect_interval=5):
+        """Receive notifications forever"""
+        while True:
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute('LISTEN %s' % push.channel)
+                pg_connection = connection.connection
+                logger.info("Listening to %s", push.channel)
+                while True:
+                    if select.select([pg_connection], [], [], keep_alive_interval) == ([], [], []):
+                        continue
+                    pg_connection.poll()
+                    while pg_connection.notifies:
+                        notify = pg_connection.notifies.pop(0)
+                        try:
+                            self.publish(json.loads(notify.payload))
+                        except (ValueError, KeyError):
+                            logger.error("Bad notification payload: %r", notify.payload)
+            except Exception:
+                logger.error("Lost connection to DB, reconnecting", exc_info=True)
+                connection.close()
+                time.sleep(reconnect_interval)
+
+
+class PushServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, hub, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, EventsHandler)
+        self.hub = hub
+        self.verbose = verbose
+
+
+class EventsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            logger.info("%s - %s", self.address_string(), format % args)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        try:
+            clan_id = int(dict(parse_qsl(url.query))['clan_id'])
+        except (KeyError, ValueError):
+            self.send_error(400, 'clan_id is required')
+            return
+        if url.path.rstrip('/') != '/events':
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('X-Accel-Buffering', 'no')
+        self.end_headers()
+
+        client = self.server.hub.subscribe(clan_id)
+        try:
+            self.write('retry: 5000\n\n')
+            while True:
+                try:
+                    payload = client.get(timeout=keep_alive_interval)
+                except queue.Empty:
+                    self.write(': keep-alive\n\n')
+                    continue
+                if payload is None:
+                    break
+                self.write('event: change\ndata: %s\n\n' % json.dumps(payload))
+        except (socket.error, IOError):
+            pass  # client has gone
+        finally:
+            self.server.hub.unsubscribe(clan_id, client)
+
+    def write(self, text):
+        self.wfile.write(text.encode('utf-8'))
+        self.wfile.flush()
+
+
+class Command(BaseCommand):
+    help = 'Push changes made by import to browsers with Server-Sent Events'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8801)
+
+    def handle(self, *args, **options):
+        hub = Hub()
+        listener = threading.Thread(target=hub.listen, name='listener')
+        listener.daemon = True
+        listener.start()
+
+        server = PushServer((options['host'], options['port']), hub, verbose=options['verbosity'] > 1)
+        logger.info("Serving events at http://%s:%s/events/", options['host'], options['port'])
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,231 @@
+# coding=utf-8
+"""Import pipeline metrics in Prometheus text exposition format
+
+Metrics live in the process memory. fetchdata writes them with wot_import_
+prefix to METRICS_TEXTFILE after every run (for node_exporter textfile
+collector), the web process serves its own metrics with wot_web_ prefix
+followed by that file at /metrics/.
+"""
+from __future__ import unicode_literals
+
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+import os
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+default_buckets = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def format_labels(labels, extra=()):
+    items = sorted(labels) + list(extra)
+    if not items:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in items
+    )
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    def render(self, prefix):
+        name = prefix + self.name
+        lines = ['# HELP %s %s' % (name, self.documentation), '# TYPE %s %s' % (name, self.type)]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.extend(self.render_value(name, labels, value))
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def render_value(self, name, labels, value):
+        return ['%s%s %s' % (name, format_labels(labels), format_value(value))]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, buckets=default_buckets):
+        super(Histogram, self).__init__(name, documentation)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * len(self.buckets), 0.0)
+            counts[bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def render_value(self, name, labels, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            lines.append('%s_bucket%s %s' % (name, format_labels(labels, [('le', format_value(bound))]), cumulative))
+        lines.append('%s_sum%s %s' % (name, format_labels(labels), format_value(total)))
+        lines.append('%s_count%s %s' % (name, format_labels(labels), cumulative))
+        return lines
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, documentation):
+        return self.register(Counter(name, documentation))
+
+    def histogram(self, name, documentation, buckets=default_buckets):
+        return self.register(Histogram(name, documentation, buckets))
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def reset(self):
+        for metric in self.metrics:
+            metric.reset()
+
+    def render(self, prefix):
+        return '\n'.join(line for metric in self.metrics for line in metric.render(prefix)) + '\n'
+
+    def write_textfile(self, path, prefix):
+        """Write metrics atomically, so collectors never read partial file"""
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self.render(prefix).encode('utf-8'))
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+
+
+registry = Registry()
+
+stage_seconds = registry.histogram(
+    'stage_seconds', 'Time spent in import stage')
+api_request_seconds = registry.histogram(
+    'api_request_seconds', 'WG API request latency by endpoint')
+api_errors = registry.counter(
+    'api_errors_total', 'Failed WG API requests by endpoint and error')
+db_queries = registry.counter(
+    'db_queries_total', 'DB queries by import stage')
+rows_written = registry.counter(
+    'rows_written_total', 'Rows inserted or updated by table')
+provinces = registry.counter(
+    'provinces_total', 'Imported provinces by result: updated, unchanged, failed')
+
+_local = threading.local()
+
+
+def current_stage():
+    return getattr(_local, 'stage', None)
+
+
+@contextmanager
+def stage(name):
+    """Time block as import stage, DB queries of block are counted for the stage"""
+    previous, _local.stage = current_stage(), name
+    try:
+        with stage_seconds.time(stage=name):
+            yield
+    finally:
+        _local.stage = previous
+
+
+@contextmanager
+def in_stage(name):
+    """Count DB queries of block for stage without timing it, e.g. in worker threads of a stage"""
+    previous, _local.stage = current_stage(), name
+    try:
+        yield
+    finally:
+        _local.stage = previous
+
+
+def observe_api_call(api, endpoint, seconds, error=None):
+    api_request_seconds.observe(seconds, api=api, endpoint=endpoint)
+    if error is not None:
+        api_errors.inc(api=api, endpoint=endpoint, error=type(error).__name__)
+
+
+class QueryCounter(deque):
+    """Replacement of connection.queries_log which counts queries instead of keeping them"""
+
+    def __init__(self):
+        super(QueryCounter, self).__init__(maxlen=0)
+
+    def append(self, query):
+        db_queries.inc(stage=current_stage() or 'other')
+
+
+def count_connection_queries(connection):
+    connection.force_debug_cursor = True
+    connection.queries_log = QueryCounter()
+
+
+def _count_new_connection_queries(sender, connection, **kwargs):
+    count_connection_queries(connection)
+
+
+def count_queries():
+    """Count DB queries of this process by stage, including connections opened later by threads
+
+    Replaces queries_log of connections, so it must not be enabled in tests
+    which inspect executed queries.
+    """
+    for connection in connections.all():
+        count_connection_queries(connection)
+    connection_created.connect(_count_new_connection_queries, dispatch_uid='global_map.metrics.count_queries')
+
+
+def textfile_contents():
+    """Metrics written by the last fetchdata run, if any"""
+    path = getattr(settings, 'METRICS_TEXTFILE', None)
+    if not path:
+        return ''
+    try:
+        with open(path, 'rb') as f:
+            return f.read().decode('utf-8')
+    except (IOError, OSError):
+        return ''
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('global_map', '0006_clanextra'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='clanextra',
+            name='clan',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='extra', serialize=False, to='global_map.Clan'),
+        ),
+    ]
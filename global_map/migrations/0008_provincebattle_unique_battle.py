@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('global_map', '0007_clanextra_related_name'),
+    ]
+
+    operations = [
+        # keep only the latest copy of duplicated battles before adding constraint
+        migrations.RunSQL(
+            'DELETE FROM global_map_provincebattle a USING global_map_provincebattle b '
+            'WHERE a.assault_id = b.assault_id AND a.round = b.round '
+            'AND a.clan_a_id = b.clan_a_id AND a.clan_b_id = b.clan_b_id AND a.id < b.id',
+            migrations.RunSQL.noop,
+        ),
+        migrations.AlterUniqueTogether(
+            name='provincebattle',
+            unique_together=set([('assault', 'round', 'clan_a', 'clan_b')]),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('global_map', '0008_provincebattle_unique_battle'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='clan',
+            name='battle_log_synced_at',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
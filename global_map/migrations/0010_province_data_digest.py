@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('global_map', '0009_clan_battle_log_synced_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='province',
+            name='data_digest',
+            field=models.CharField(max_length=40, null=True),
+        ),
+    ]
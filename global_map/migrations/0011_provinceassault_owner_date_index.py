@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('global_map', '0010_province_data_digest'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='provinceassault',
+            index_together=set([('current_owner', 'date')]),
+        ),
+        # unique (provinceassault_id, clan_id) index can't be used to find assaults of a clan
+        migrations.RunSQL(
+            'CREATE INDEX global_map_provinceassault_clans_clan_assault '
+            'ON global_map_provinceassault_clans (clan_id, provinceassault_id)',
+            'DROP INDEX global_map_provinceassault_clans_clan_assault',
+        ),
+    ]
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import global_map.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('global_map', '0011_provinceassault_owner_date_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RefreshJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('clan', 'Clan'), ('province', 'Province')], max_length=10)),
+                ('target', models.CharField(max_length=255)),
+                ('state', models.CharField(default='pending', max_length=10)),
+                ('priority', models.IntegerField(default=0)),
+                ('attempts', models.IntegerField(default=0)),
+                ('max_attempts', models.IntegerField(default=5)),
+                ('run_after', models.DateTimeField(default=global_map.models.utc_now)),
+                ('lease_until', models.DateTimeField(null=True)),
+                ('worker', models.CharField(max_length=255, null=True)),
+                ('last_error', models.TextField(null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='refreshjob',
+            index_together=set([('state', 'priority', 'run_after')]),
+        ),
+        # only one queued or running job per target, enqueue relies on it for ON CONFLICT
+        migrations.RunSQL(
+            "CREATE UNIQUE INDEX global_map_refreshjob_active_target "
+            "ON global_map_refreshjob (kind, target) WHERE state IN ('pending', 'running')",
+            'DROP INDEX global_map_refreshjob_active_target',
+        ),
+    ]
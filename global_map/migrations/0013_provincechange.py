@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import global_map.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('global_map', '0012_refreshjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProvinceChange',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('field', models.CharField(max_length=32)),
+                ('old_value', models.TextField(null=True)),
+                ('new_value', models.TextField(null=True)),
+                ('created_at', models.DateTimeField(db_index=True, default=global_map.models.utc_now)),
+                ('battle', models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='global_map.ProvinceBattle')),
+                ('province', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='changes', to='global_map.Province')),
+            ],
+        ),
+    ]
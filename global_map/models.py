@@ -1,25 +1,31 @@
 # coding=utf-8
 from __future__ import unicode_literals
 
-from django.db import models
+from django.db import connection, models
 import pytz
-import requests
 
 from datetime import timedelta
 import datetime
+import logging
 import math
+import threading
 
 import wargaming
+from wargaming.exceptions import RequestError
 from django.db.models.signals import pre_save
-from django.db.models import Q
+from django.db.models import Prefetch, Q
 from django.contrib.postgres.fields import JSONField
 from django.dispatch import receiver
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
 from django.utils.functional import cached_property
 
-wot = wargaming.WoT(settings.WARGAMING_KEY, language='ru', region='ru')
-wgn = wargaming.WGN(settings.WARGAMING_KEY, language='ru', region='ru')
+from global_map import game_api, metrics
+from global_map.api_cache import CachedClient
+
+wot = CachedClient(wargaming.WoT(settings.WARGAMING_KEY, language='ru', region='ru'), 'wot', settings.WG_API_URL)
+wgn = CachedClient(wargaming.WGN(settings.WARGAMING_KEY, language='ru', region='ru'), 'wgn', settings.WG_API_URL)
+logger = logging.getLogger(__name__)
 
 
 def utc_now():
@@ -70,8 +76,7 @@ class TournamentInfo(dict):
         #  u'size': 32,
         #  u'start_time': u'19:00:00',
         #  u'turns_till_primetime': 11}
-        self.update(requests.get(
-            'https://ru.wargaming.net/globalmap/game_api/tournament_info?alias=%s' % province_id).json())
+        self.update(game_api.get_json('tournament_info', params={'alias': province_id}))
         try:
             province = Province.objects.get(province_id=self['province_id'], front__front_id=self['front_id'])
         except Province.DoesNotExist:
@@ -126,6 +131,8 @@ class Clan(models.Model):
     elo_6 = models.IntegerField(null=True)
     elo_8 = models.IntegerField(null=True)
     elo_10 = models.IntegerField(null=True)
+    # created_at of the newest clan battle log entry already processed
+    battle_log_synced_at = models.DateTimeField(null=True)
 
     def __repr__(self):
         return '<Clan: %s>' % self.tag
@@ -149,11 +156,15 @@ class Clan(models.Model):
             'elo_10': self.elo_10,
         }
 
-    def as_json_with_arena(self, arena_id):
+    def as_json_with_arena(self, arena_id, arena_stats=None):
+        """arena_stats is {(clan_id, arena_id): ClanArenaStat} preloaded by load_assaults"""
         data = self.as_json()
-        stat = self.arena_stats.filter(arena_id=arena_id)
+        if arena_stats is not None:
+            stat = arena_stats.get((self.pk, arena_id))
+        else:
+            stat = self.arena_stats.filter(arena_id=arena_id).first()
         if stat:
-            data['arena_stat'] = stat[0].as_json()
+            data['arena_stat'] = stat.as_json()
         else:
             data['arena_stat'] = ClanArenaStat(
                 clan=self,
@@ -164,6 +175,96 @@ class Clan(models.Model):
         return data
 
 
+def get_or_create_clans(clan_ids):
+    """Get or create clans by ids with constant number of queries
+
+    Returns dict {clan_id: Clan}. Unlike Clan.objects.get_or_create it does
+    not send pre_save, so missing clans are created without tag and title,
+    clan_resolver fills them at the end of import.
+    """
+    clan_ids = set(clan_ids)
+    if not clan_ids:
+        return {}
+    clans = Clan.objects.in_bulk(clan_ids)
+    missing = clan_ids - set(clans)
+    if missing:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'INSERT INTO {table} (id) VALUES {values} ON CONFLICT (id) DO NOTHING'.format(
+                    table=Clan._meta.db_table,
+                    values=', '.join(['(%s)'] * len(missing)),
+                ),
+                list(missing),
+            )
+            metrics.rows_written.inc(cursor.rowcount, table='clan')
+        for clan_id in missing:
+            # bound to the DB like a fetched row, so it can be added to relations
+            clan = clans[clan_id] = Clan(pk=clan_id)
+            clan._state.adding = False
+            clan._state.db = connection.alias
+    return clans
+
+
+class ClanResolver(object):
+    """Fetches tags and titles of clans saved without them from WG API in batches
+
+    Clans are saved by importer and web processes with id only. At the end of
+    import add_untagged() queues clans without tag from the DB and resolve()
+    looks them up. Disbanded clans get an empty tag, so they are not queued
+    again.
+    """
+    batch_size = 100  # max ids per wgn.clans.info request
+    disbanded_tag = ''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = set()
+
+    def add_untagged(self):
+        """Queue clans which are still without tag in the DB"""
+        clan_ids = Clan.objects.filter(tag=None).values_list('id', flat=True)
+        with self._lock:
+            self._pending.update(clan_ids)
+
+    def resolve(self):
+        with self._lock:
+            pending, self._pending = sorted(self._pending), set()
+
+        resolved = set()
+        try:
+            for i in range(0, len(pending), self.batch_size):
+                batch = pending[i:i + self.batch_size]
+                try:
+                    clans_info = wgn.clans.info(clan_id=','.join(str(clan_id) for clan_id in batch),
+                                                fields='tag,name')
+                except RequestError as e:
+                    logger.error("wgn.clans.info returned %s (%s), will retry later", e.code, e.message)
+                    continue
+                for clan_id in batch:
+                    if str(clan_id) not in clans_info:
+                        continue
+                    clan_info = clans_info[str(clan_id)]
+                    if clan_info:
+                        Clan.objects.filter(pk=clan_id).update(tag=clan_info['tag'], title=clan_info['name'])
+                    else:
+                        # null info is a disbanded clan, there is nothing to retry
+                        Clan.objects.filter(pk=clan_id).update(tag=self.disbanded_tag)
+                    resolved.add(clan_id)
+        finally:
+            unresolved = set(pending) - resolved
+            if unresolved:
+                with self._lock:
+                    self._pending.update(unresolved)
+
+
+clan_resolver = ClanResolver()
+
+
+class ClanExtra(models.Model):
+    clan = models.OneToOneField(Clan, primary_key=True, related_name='extra')
+    globalmap_cookie = models.TextField(null=True)
+
+
 class Player(models.Model):
     nickname = models.CharField(max_length=255)
     clan = models.ForeignKey(Clan, null=True)
@@ -186,6 +287,8 @@ class Province(models.Model):
     arena_name = models.CharField(max_length=255)
     prime_time = models.TimeField()
     server = models.CharField(max_length=10)
+    # sha1 of the last applied wot.globalmap.provinces data
+    data_digest = models.CharField(max_length=40, null=True)
 
     def __repr__(self):
         return '<Province: %s>' % self.province_id
@@ -298,6 +401,9 @@ class ProvinceAssault(models.Model):
     class Meta:
         ordering = ('date', )
         unique_together = ('date', 'province')
+        index_together = [
+            ('current_owner', 'date'),
+        ]
 
     def __repr__(self):
         return '<ProvinceAssault @%s: %s owned by %s>' % (
@@ -337,7 +443,11 @@ class ProvinceAssault(models.Model):
 
     def clan_battles(self, clan):
         max_rounds = len(self.planned_times)
-        existing_battles = {b.round: b for b in self.battles.filter(Q(clan_a=clan) | Q(clan_b=clan))}
+        if 'battles' in getattr(self, '_prefetched_objects_cache', {}):
+            battles = [b for b in self.battles.all() if clan.pk in (b.clan_a_id, b.clan_b_id)]
+        else:
+            battles = self.battles.filter(Q(clan_a=clan) | Q(clan_b=clan))
+        existing_battles = {b.round: b for b in battles}
 
         res = []
         for round_number in range(1, max_rounds + 1):
@@ -363,13 +473,13 @@ class ProvinceAssault(models.Model):
     def max_rounds(self):
         return len(self.planned_times)
 
-    def as_clan_json(self, clan, current_only=True):
+    def as_clan_json(self, clan, current_only=True, arena_stats=None):
         if current_only:
-            battles = [b.as_json() for b in self.clan_battles(clan)
+            battles = [b.as_json(arena_stats) for b in self.clan_battles(clan)
                        if b.round >= self.round_number and self.status != 'FINISHED'
                        or self.datetime > utc_now()]
         else:
-            battles = [b.as_json() for b in self.clan_battles(clan)]
+            battles = [b.as_json(arena_stats) for b in self.clan_battles(clan)]
 
         if self.current_owner == clan:
             mode = 'defence'
@@ -380,11 +490,43 @@ class ProvinceAssault(models.Model):
             'mode': mode,
             'province_info': self.province.as_json(),
             'prime_time': self.datetime,
-            'clans': {c.pk: c.as_json_with_arena(self.arena_id) for c in self.clans.all()},
+            'clans': {c.pk: c.as_json_with_arena(self.arena_id, arena_stats) for c in self.clans.all()},
             'battles': battles,
         }
 
 
+def load_assaults(assaults):
+    """Fetch assaults with everything as_clan_json needs in a fixed number of queries
+
+    Returns (assaults, arena_stats), pass arena_stats to as_clan_json.
+    """
+    assaults = list(
+        assaults
+        .select_related('province__front', 'province__province_owner', 'current_owner')
+        .prefetch_related('clans', Prefetch('battles', queryset=ProvinceBattle.objects.select_related(
+            'clan_a', 'clan_b', 'winner')))
+    )
+    clan_ids = set()
+    arena_ids = set()
+    for assault in assaults:
+        arena_ids.add(assault.arena_id)
+        clan_ids.update(clan.pk for clan in assault.clans.all())
+        if assault.current_owner_id:
+            clan_ids.add(assault.current_owner_id)
+        for battle in assault.battles.all():
+            battle.province = assault.province
+            arena_ids.add(battle.arena_id)
+            clan_ids.update([battle.clan_a_id, battle.clan_b_id])
+
+    arena_stats = {}
+    if clan_ids:
+        arena_stats = {
+            (stat.clan_id, stat.arena_id): stat
+            for stat in ClanArenaStat.objects.filter(clan_id__in=clan_ids, arena_id__in=arena_ids)
+        }
+    return assaults, arena_stats
+
+
 class ProvinceBattle(models.Model):
     assault = models.ForeignKey(ProvinceAssault, related_name='battles')
     province = models.ForeignKey(Province, related_name='battles')
@@ -397,6 +539,7 @@ class ProvinceBattle(models.Model):
 
     class Meta:
         ordering = ('round', 'start_at')
+        unique_together = ('assault', 'round', 'clan_a', 'clan_b')
 
     def __repr__(self):
         clan_a_tag = clan_b_tag = province_id = None
@@ -431,7 +574,7 @@ class ProvinceBattle(models.Model):
         else:
             return 'Round 1 / %s' % (2 ** power)
 
-    def as_json(self):
+    def as_json(self, arena_stats=None):
         try:
             clan_a = self.clan_a
         except ObjectDoesNotExist:
@@ -443,8 +586,8 @@ class ProvinceBattle(models.Model):
         return {
             'planned_start_at': self.round_datetime,
             'real_start_at': self.start_at,
-            'clan_a': clan_a.as_json_with_arena(self.arena_id) if clan_a else None,
-            'clan_b': clan_b.as_json_with_arena(self.arena_id) if clan_b else None,
+            'clan_a': clan_a.as_json_with_arena(self.arena_id, arena_stats) if clan_a else None,
+            'clan_b': clan_b.as_json_with_arena(self.arena_id, arena_stats) if clan_b else None,
             'winner': self.winner.as_json() if self.winner else None
         }
 
@@ -458,11 +601,113 @@ class ProvinceTag(models.Model):
         return "<ProvinceTag %s: %s@%s>" % (self.date, self.tag, self.province_id)
 
 
+class ProvinceChange(models.Model):
+    """Append-only feed of province changes written by fetchdata
+
+    Values are stored as text: clan ids, comma-separated sorted clan ids for
+    attackers, ISO datetimes for battle start_at. battle_id is set for battle
+    events only and is kept after battle is deleted.
+    """
+    FIELD_OWNER = 'owner'
+    FIELD_ROUND_NUMBER = 'round_number'
+    FIELD_ATTACKERS = 'attackers'
+    FIELD_BATTLE = 'battle'  # new battle, new_value is start_at
+    FIELD_BATTLE_START_AT = 'battle_start_at'
+    FIELD_WINNER = 'winner'
+
+    id = models.BigAutoField(primary_key=True)
+    province = models.ForeignKey(Province, related_name='changes')
+    battle = models.ForeignKey(ProvinceBattle, null=True, related_name='+',
+                               on_delete=models.DO_NOTHING, db_constraint=False)
+    field = models.CharField(max_length=32)
+    old_value = models.TextField(null=True)
+    new_value = models.TextField(null=True)
+    created_at = models.DateTimeField(default=utc_now, db_index=True)
+
+    def __repr__(self):
+        return '<ProvinceChange %s: %s %s %r -> %r>' % (
+            self.pk, self.province_id, self.field, self.old_value, self.new_value)
+
+    @staticmethod
+    def value(value):
+        if value is None:
+            return None
+        if isinstance(value, datetime.datetime):
+            return value.isoformat()
+        if isinstance(value, (set, frozenset, list, tuple)):
+            return ','.join(str(i) for i in sorted(value))
+        return str(value)
+
+    @classmethod
+    def diff(cls, province, field, old_value, new_value, battle_id=None):
+        """Returns unsaved change if value changed, otherwise None"""
+        old_value, new_value = cls.value(old_value), cls.value(new_value)
+        if old_value == new_value:
+            return None
+        return cls(province=province, battle_id=battle_id, field=field, old_value=old_value, new_value=new_value)
+
+    def as_json(self):
+        return {
+            'id': self.id,
+            'province_id': self.province.province_id,
+            'battle_id': self.battle_id,
+            'field': self.field,
+            'old': self.old_value,
+            'new': self.new_value,
+            'created_at': self.created_at,
+        }
+
+
+class RefreshJob(models.Model):
+    """Clan or province refresh task consumed by fetchdata --queue-worker, see global_map/work_queue.py"""
+    KIND_CLAN = 'clan'
+    KIND_PROVINCE = 'province'
+
+    STATE_PENDING = 'pending'
+    STATE_RUNNING = 'running'
+    STATE_DONE = 'done'
+    STATE_FAILED = 'failed'
+
+    kind = models.CharField(max_length=10, choices=((KIND_CLAN, 'Clan'), (KIND_PROVINCE, 'Province')))
+    target = models.CharField(max_length=255)  # clan id or "front_id/province_id"
+    state = models.CharField(max_length=10, default=STATE_PENDING)
+    priority = models.IntegerField(default=0)  # lower is more urgent: seconds until prime time
+    attempts = models.IntegerField(default=0)
+    max_attempts = models.IntegerField(default=5)
+    run_after = models.DateTimeField(default=utc_now)
+    lease_until = models.DateTimeField(null=True)
+    worker = models.CharField(max_length=255, null=True)
+    last_error = models.TextField(null=True)
+    progress = models.CharField(max_length=32, null=True)  # stage of running job
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        index_together = [
+            ('state', 'priority', 'run_after'),
+        ]
+
+    def __repr__(self):
+        return '<RefreshJob %s: %s %s (%s)>' % (self.pk, self.kind, self.target, self.state)
+
+    def as_json(self):
+        return {
+            'id': self.pk,
+            'kind': self.kind,
+            'target': self.target,
+            'state': self.state,
+            'progress': self.progress,
+            'attempts': self.attempts,
+            'error': self.last_error,
+            'created_at': self.created_at,
+            'updated_at': self.updated_at,
+        }
+
+
 @receiver(pre_save, sender=Clan)
 def fetch_minimum_clan_info(sender, instance, **kwargs):
-    if (not instance.tag or not instance.title) and instance.pk:
-        instance.force_update()
-    elif not instance.pk and instance.tag:
+    # clans saved by id only are resolved by clan_resolver at the end of import
+    if not instance.pk and instance.tag:
         info = [i for i in wgn.clans.list(search=instance.tag) if i['tag'] == instance.tag]
         if len(info) == 1:
             instance.pk = info[0]['clan_id']
@@ -474,7 +719,7 @@ def fetch_minimum_clan_info(sender, instance, **kwargs):
 
 
 @receiver(pre_save, sender=Province)
-def fetch_minimum_clan_info(sender, instance, **kwargs):
+def fetch_minimum_province_info(sender, instance, **kwargs):
     required_fields =  ['province_name', 'arena_id', 'arena_name', 'prime_time', 'server']
     for field in required_fields:
         if not getattr(instance, field):
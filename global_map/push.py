@@ -0,0 +1,44 @@
+# coding=utf-8
+"""Publishing of import changes to push_events server through Postgres NOTIFY
+
+Notifications are sent in the importer transaction, so Postgres delivers
+them only when changes are committed. Payload is JSON:
+
+    {"clans": [clan ids whose schedules changed], "dates": ["2016-11-27"],
+     "changes": [ProvinceChange.as_json()]}
+"""
+from __future__ import unicode_literals
+
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection
+
+channel = 'global_map_changes'
+max_payload_size = 7900  # Postgres limit is 8000 bytes
+
+
+def payloads(clan_ids, dates, changes):
+    """Split changes into payloads which fit into notification"""
+    head = {'clans': sorted(clan_ids), 'dates': sorted(str(date) for date in dates)}
+    chunk = []
+    for change in changes:
+        payload = json.dumps(dict(head, changes=chunk + [change]), cls=DjangoJSONEncoder)
+        if chunk and len(payload.encode('utf-8')) > max_payload_size:
+            yield json.dumps(dict(head, changes=chunk), cls=DjangoJSONEncoder)
+            chunk = []
+        chunk.append(change)
+    if chunk:
+        yield json.dumps(dict(head, changes=chunk), cls=DjangoJSONEncoder)
+
+
+def publish(clan_dates, changes):
+    """Notify push_events of ProvinceChange list, clan_dates are (clan_id, date) of changed schedules"""
+    if not changes:
+        return
+    params = []
+    for payload in payloads(set(c for c, d in clan_dates if c), set(d for c, d in clan_dates),
+                            [change.as_json() for change in changes]):
+        params.extend([channel, payload])
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT ' + ', '.join(['pg_notify(%s, %s)'] * (len(params) // 2)), params)
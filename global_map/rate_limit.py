@@ -0,0 +1,123 @@
+# coding=utf-8
+"""Throttling and retries of WG API calls
+
+WG limits requests per application id, and the limit is shared by every
+thread and process which uses the same WARGAMING_KEY. Token bucket state is
+kept in a locked file, so concurrent imports (threads, process pool, several
+fetchdata commands on one host) are throttled together.
+"""
+from __future__ import unicode_literals
+
+import fcntl
+import logging
+import os
+import threading
+import time
+
+import requests
+from django.conf import settings
+from retrying import retry
+from wargaming.exceptions import RequestError
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+    def __init__(self, rate, capacity=None, path=None):
+        self.rate = float(rate)  # tokens per second
+        self.capacity = float(capacity or rate)
+        self.path = path
+        self._lock = threading.Lock()
+        self._tokens = self.capacity
+        self._updated_at = time.time()
+
+    def _take(self, tokens, updated_at):
+        """Returns (tokens, updated_at, seconds to wait)"""
+        now = time.time()
+        tokens = min(self.capacity, tokens + (now - updated_at) * self.rate)
+        if tokens >= 1:
+            return tokens - 1, now, 0
+        return tokens, now, (1 - tokens) / self.rate
+
+    def _take_shared(self):
+        with open(self.path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    tokens, updated_at = [float(i) for i in f.read().split()]
+                except ValueError:  # new or broken state file
+                    tokens, updated_at = self.capacity, time.time()
+                tokens, updated_at, wait = self._take(tokens, updated_at)
+                f.seek(0)
+                f.truncate()
+                f.write('%r %r' % (tokens, updated_at))
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return wait
+
+    def _take_local(self):
+        self._tokens, self._updated_at, wait = self._take(self._tokens, self._updated_at)
+        return wait
+
+    def acquire(self):
+        """Block until request is allowed"""
+        while True:
+            with self._lock:
+                if self.path:
+                    try:
+                        wait = self._take_shared()
+                    except (IOError, OSError):
+                        logger.warning("Can't use shared rate limit state %s, limiting this process only",
+                                       self.path, exc_info=True)
+                        self.path = None
+                        wait = self._take_local()
+                else:
+                    wait = self._take_local()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+
+def is_retryable(exception):
+    """Rate limit errors, 5xx errors and network failures are worth retrying
+
+    WG API reports invalid parameters with code 407 as well, only its
+    REQUEST_LIMIT_EXCEEDED message means the request may succeed later.
+    """
+    if isinstance(exception, RequestError):
+        retryable = exception.code in (503, 504) or exception.message == 'REQUEST_LIMIT_EXCEEDED'
+    elif isinstance(exception, requests.HTTPError):
+        retryable = exception.response is not None and (
+            exception.response.status_code == 429 or exception.response.status_code >= 500)
+    else:
+        retryable = isinstance(exception, (requests.ConnectionError, requests.Timeout))
+    if retryable:
+        logger.warning("WG API request failed, retrying: %r", exception)
+    return retryable
+
+
+def bucket_from_settings(name):
+    config = settings.WG_API_RATE_LIMIT
+    path = config['STATE_DIR'] and os.path.join(config['STATE_DIR'], 'wot_battles_%s.bucket' % name)
+    return TokenBucket(config['%s_RATE' % name.upper()], path=path)
+
+
+wg_api_bucket = bucket_from_settings('wg_api')
+game_api_bucket = bucket_from_settings('game_api')
+
+
+def throttled(bucket, func):
+    """Call func when bucket allows, retry on retryable errors with jittered exponential backoff"""
+    def attempt():
+        bucket.acquire()
+        return func()
+
+    return retry(
+        retry_on_exception=is_retryable,
+        stop_max_attempt_number=settings.WG_API_RATE_LIMIT['RETRIES'],
+        wait_exponential_multiplier=500,
+        wait_exponential_max=10000,
+        wait_jitter_max=1000,
+    )(attempt)()
@@ -0,0 +1,36 @@
+import shutil
+import tempfile
+
+from django.test import SimpleTestCase
+import mock
+
+from global_map.api_cache import CacheMiss, ResponseCache
+
+
+class TestResponseCache(SimpleTestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_record_and_replay(self):
+        fetch = mock.Mock(return_value=[{'province_id': 'aarhus'}])
+        ResponseCache('record', self.path).call('wot.globalmap.provinces', {'front_id': 'west'}, fetch)
+
+        replay = ResponseCache('replay', self.path)
+        assert replay.call('wot.globalmap.provinces', {'front_id': 'west'}, fetch) == [{'province_id': 'aarhus'}]
+        assert fetch.call_count == 1
+        with self.assertRaises(CacheMiss):
+            replay.call('wot.globalmap.provinces', {'front_id': 'east'}, fetch)
+
+    def test_ttl(self):
+        fetch = mock.Mock(return_value={'state': 'active'})
+        cache = ResponseCache('ttl', self.path, ttl=60)
+        cache.call('wot.globalmap.info', {}, fetch)
+        cache.call('wot.globalmap.info', {}, fetch)
+        assert fetch.call_count == 1
+
+        cache.ttl = -1
+        cache.call('wot.globalmap.info', {}, fetch)
+        assert fetch.call_count == 2
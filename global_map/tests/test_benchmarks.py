@@ -0,0 +1,196 @@
+"""End-to-end benchmarks of import and read paths on a synthetic season
+
+Skipped unless WOT_BENCHMARK is set, run with:
+
+    WOT_BENCHMARK=1 py.test -s global_map/tests/test_benchmarks.py
+
+Season size is set by WOT_BENCHMARK_PROVINCES and WOT_BENCHMARK_CLANS,
+WOT_BENCHMARK_BUDGET_SCALE multiplies time budgets for slow machines.
+WG API is mocked, benchmarks run offline.
+"""
+from __future__ import print_function
+
+from contextlib import contextmanager
+import datetime
+import os
+import random
+import time
+import unittest
+
+import mock
+import pytz
+from django.db import connection
+from django.test import RequestFactory, TestCase
+from django.test.utils import CaptureQueriesContext
+
+from global_map.models import Clan, Front, Province, ProvinceAssault, ProvinceBattle
+from global_map.management.commands.fetchdata import update_province, update_winners_from_log
+from global_map.tests.test_fetchdata import ProvinceData
+from global_map.views import ListBattlesJson
+
+try:
+    import tracemalloc
+except ImportError:  # python 2
+    tracemalloc = None
+    import resource
+
+provinces_count = int(os.environ.get('WOT_BENCHMARK_PROVINCES', 1000))
+clans_count = int(os.environ.get('WOT_BENCHMARK_CLANS', 200))
+budget_scale = float(os.environ.get('WOT_BENCHMARK_BUDGET_SCALE', 1))
+
+competitors_count = 8  # 3 rounds of tournament and a battle with owner
+season_date = '2016-11-27'
+battles_start_at = '2016-11-27T18:15:00'
+
+# budgets per item: seconds, queries, peak memory in MB for the whole run
+budgets = {
+    'update_province': (0.02, 20, 100),
+    'update_winners_from_log': (0.05, 10, 100),
+    'as_clan_json': (0.01, 15, 50),
+    # cache lookup, version and response writes with their savepoints, clan and 4 queries of load_assaults;
+    # a query per assault would add dozens
+    'ListBattlesJson.get': (0.5, 20, 50),
+}
+
+
+@contextmanager
+def peak_memory():
+    """Yields list, which gets peak memory in MB allocated by block"""
+    result = []
+    if tracemalloc:
+        tracemalloc.start()
+        try:
+            yield result
+            result.append(tracemalloc.get_traced_memory()[1] / 1024.0 / 1024)
+        finally:
+            tracemalloc.stop()
+    else:
+        # maximum resident size only grows, growth is the best available estimate
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        yield result
+        result.append((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) / 1024.0)
+
+
+@unittest.skipUnless(os.environ.get('WOT_BENCHMARK'), 'set WOT_BENCHMARK=1 to run benchmarks')
+class TestSeasonBenchmark(TestCase):
+    def setUp(self):
+        # season is over, utc_now of models decides which rounds are in the past
+        utc_now = mock.patch('global_map.models.utc_now',
+                             return_value=datetime.datetime(2016, 11, 27, 22, 0, 0, tzinfo=pytz.UTC))
+        utc_now.start()
+        self.addCleanup(utc_now.stop)
+
+        self.random = random.Random(35039)
+        front = Front.objects.create(front_id='test_front_id', max_vehicle_level=10)
+        Clan.objects.bulk_create([
+            Clan(pk=i, tag='C%s' % i, title='Clan %s' % i) for i in range(1, clans_count + 1)
+        ])
+        Province.objects.bulk_create([
+            Province(province_id='province_%s' % i, front=front, province_name='Province %s' % i,
+                     arena_id='arena_%s' % (i % 20), arena_name='Arena %s' % (i % 20), prime_time='18:15',
+                     server='RU1')
+            for i in range(provinces_count)
+        ])
+        self.provinces = list(Province.objects.select_related('front').order_by('pk'))
+
+    def measure(self, name, items, func):
+        """Run func, print report and check budget of name scaled to number of items"""
+        max_seconds, max_queries, max_memory = budgets[name]
+        started = time.time()
+        with peak_memory() as memory, CaptureQueriesContext(connection) as queries:
+            result = func()
+        elapsed = time.time() - started
+
+        print('\n%s: %s items in %.3fs (%.4fs per item), %s queries (%.1f per item), peak memory %.1f MB' % (
+            name, items, elapsed, elapsed / items, len(queries), float(len(queries)) / items, memory[0]))
+        assert elapsed <= max_seconds * items * budget_scale, '%s exceeded time budget' % name
+        assert len(queries) <= max_queries * items, '%s exceeded queries budget' % name
+        assert memory[0] <= max_memory, '%s exceeded memory budget' % name
+        return result
+
+    def season_data(self):
+        """Tournament of every province: list of (province, [ProvinceData of every round])"""
+        clan_ids = list(range(1, clans_count + 1))
+        season = []
+        for province in self.provinces:
+            owner_id, competitors = clan_ids[0], self.random.sample(clan_ids[1:], competitors_count)
+            rounds = []
+            for round_number in range(1, 5):
+                province_data = ProvinceData(
+                    province_id=province.province_id, arena_id=province.arena_id, arena_name=province.arena_name,
+                    competitors=competitors, round_number=round_number, owner_clan_id=owner_id,
+                    status='STARTED', battles_start_at=battles_start_at)
+                province_data.generate_battles(competitors if len(competitors) > 1 else competitors + [owner_id])
+                rounds.append(province_data)
+                competitors = competitors[::2]
+            season.append((province, rounds))
+        return season
+
+    def import_season(self):
+        for province, rounds in self.season_data():
+            for province_data in rounds:
+                update_province(province, province_data)
+
+    def battle_log(self, clan_id):
+        """Clan log pages as returned by game_api.iter_json_items, the newest entries first"""
+        entries = []
+        for battle in ProvinceBattle.objects.filter(clan_a_id=clan_id).select_related('province'):
+            entries.append({
+                'created_at': (battle.start_at + datetime.timedelta(minutes=10)).strftime('%Y-%m-%d %H:%M:%S'),
+                'type': 'TOURNAMENT_BATTLE_WON',
+                'target_province': {'alias': battle.province.province_id},
+                'enemy_clan': {'id': battle.clan_b_id},
+                'winner_id': clan_id,
+            })
+        entries.sort(key=lambda entry: entry['created_at'], reverse=True)
+        return entries
+
+    def test_update_province(self):
+        season = self.season_data()
+
+        def run():
+            for province, rounds in season:
+                for province_data in rounds:
+                    update_province(province, province_data)
+
+        self.measure('update_province', len(season) * 4, run)
+        assert ProvinceBattle.objects.count() == provinces_count * (4 + 2 + 1 + 1)
+
+    def test_update_winners_from_log(self):
+        self.import_season()
+        clans = list(Clan.objects.all())
+        logs = {clan.pk: self.battle_log(clan.pk) for clan in clans}
+
+        def iter_json_items(path, key, params=None, **kwargs):
+            clan_id = int(path.split('/')[1])
+            page_number, page_size = params['page_number'], params['page_size']
+            return iter(logs[clan_id][(page_number - 1) * page_size:page_number * page_size])
+
+        def run():
+            for clan in clans:
+                update_winners_from_log(clan)
+
+        with mock.patch('global_map.management.commands.fetchdata.game_api.iter_json_items',
+                        side_effect=iter_json_items):
+            self.measure('update_winners_from_log', len(clans), run)
+        assert not ProvinceBattle.objects.filter(winner=None).exists()
+
+    def test_as_clan_json(self):
+        self.import_season()
+        clan = Clan.objects.get(pk=1)  # owner of every province
+        assaults = list(ProvinceAssault.objects.filter(current_owner=clan).select_related('province'))
+        self.measure('as_clan_json', len(assaults),
+                     lambda: [assault.as_clan_json(clan, current_only=False) for assault in assaults])
+
+    def test_list_battles_json(self):
+        self.import_season()
+        factory = RequestFactory()
+        view = ListBattlesJson.as_view()
+        clan_ids = list(range(2, min(clans_count, 20) + 1))
+
+        def run():
+            for clan_id in clan_ids:
+                response = view(factory.get('/battles/%s/' % season_date, {'clan_id': clan_id}), date=season_date)
+                assert response.status_code == 200
+
+        self.measure('ListBattlesJson.get', len(clan_ids), run)
@@ -0,0 +1,76 @@
+from django.test import TestCase
+import mock
+
+from global_map.models import Clan, ClanResolver, get_or_create_clans
+
+
+class TestClanResolver(TestCase):
+    @staticmethod
+    def clans_info(clan_id, fields):
+        return {i: {'tag': 'C%s' % i, 'name': 'Clan %s' % i} for i in clan_id.split(',')}
+
+    def test_save_does_not_fetch_clan_info(self):
+        with mock.patch('global_map.models.wgn') as wgn, \
+                mock.patch('global_map.models.clan_resolver') as clan_resolver:
+            Clan.objects.create(pk=1)
+        assert not wgn.clans.info.called
+        # web processes never resolve, clans are picked up from the DB by importer
+        assert not clan_resolver.method_calls
+
+    def test_resolve_in_batches(self):
+        get_or_create_clans(range(1, 151))
+        resolver = ClanResolver()
+        resolver.add_untagged()
+
+        with mock.patch('global_map.models.wgn') as wgn:
+            wgn.clans.info.side_effect = self.clans_info
+            resolver.resolve()
+
+        assert wgn.clans.info.call_count == 2
+        assert Clan.objects.get(pk=150).tag == 'C150'
+        assert not Clan.objects.filter(tag=None).exists()
+
+    def test_unresolved_clans_stay_queued(self):
+        get_or_create_clans(range(1, 151))
+        resolver = ClanResolver()
+        resolver.add_untagged()
+
+        with mock.patch('global_map.models.wgn') as wgn:
+            # the first batch misses a clan, the second one fails
+            wgn.clans.info.side_effect = [
+                {str(i): {'tag': 'C%s' % i, 'name': 'Clan %s' % i} for i in range(2, 101)},
+                ValueError('bad response'),
+            ]
+            with self.assertRaises(ValueError):
+                resolver.resolve()
+
+            wgn.clans.info.side_effect = self.clans_info
+            resolver.resolve()
+
+        assert wgn.clans.info.call_args[1]['clan_id'] == ','.join(str(i) for i in [1] + list(range(101, 151)))
+        assert not Clan.objects.filter(tag=None).exists()
+
+    def test_add_untagged(self):
+        Clan.objects.bulk_create([Clan(pk=1), Clan(pk=2, tag='C2', title='Clan 2')])
+        resolver = ClanResolver()
+        resolver.add_untagged()
+
+        with mock.patch('global_map.models.wgn') as wgn:
+            wgn.clans.info.side_effect = self.clans_info
+            resolver.resolve()
+
+        wgn.clans.info.assert_called_once_with(clan_id='1', fields='tag,name')
+        assert Clan.objects.get(pk=1).tag == 'C1'
+
+    def test_disbanded_clan_is_not_requested_again(self):
+        Clan.objects.bulk_create([Clan(pk=1), Clan(pk=2)])
+        resolver = ClanResolver()
+        with mock.patch('global_map.models.wgn') as wgn:
+            wgn.clans.info.return_value = {'1': {'tag': 'C1', 'name': 'Clan 1'}, '2': None}
+            resolver.add_untagged()
+            resolver.resolve()
+            resolver.add_untagged()
+            resolver.resolve()
+
+        assert wgn.clans.info.call_count == 1
+        assert Clan.objects.get(pk=2).tag == ''
@@ -0,0 +1,31 @@
+from datetime import timedelta
+
+from django.test import SimpleTestCase
+
+from global_map.management.commands.fake_wgapi import FakeMap
+
+
+class TestFakeMap(SimpleTestCase):
+    def setUp(self):
+        self.map = FakeMap(fronts=1, provinces=2, clans=20, round_seconds=60)
+
+    def province_data(self, seconds):
+        now = self.map.started_at + timedelta(seconds=seconds)
+        return self.map.globalmap_provinces({'front_id': 'front_0', 'province_id': 'province_0'}, now)[0]
+
+    def test_tournament_progress(self):
+        rounds = [self.province_data(60 * i + 1) for i in range(5)]
+        assert [(d['status'], len(d['competitors']), len(d['active_battles'])) for d in rounds] == [
+            ('STARTED', 8, 4), ('STARTED', 4, 2), ('STARTED', 2, 1), ('STARTED', 1, 1), ('FINISHED', 0, 0),
+        ]
+        final = rounds[3]['active_battles'][0]
+        assert rounds[4]['owner_clan_id'] in (final['clan_a']['clan_id'], final['clan_b']['clan_id'])
+
+    def test_clan_log(self):
+        now = self.map.started_at + timedelta(seconds=60 * 5)
+        tournament = self.map.tournaments(now)[0]
+        clan_a, clan_b, winner_id = tournament.rounds[0][0]
+        log = self.map.clan_log(clan_a, {'page_number': 1, 'page_size': 100}, now)['data']
+        assert {'province_0'} <= set(entry['target_province']['alias'] for entry in log)
+        first_battle = [entry for entry in log if entry['enemy_clan']['id'] == clan_b][0]
+        assert first_battle['winner_id'] == winner_id
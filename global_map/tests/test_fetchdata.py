@@ -1,10 +1,14 @@
 import mock
 import datetime
 import pytz
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 
-from global_map.models import Clan, Front, Province, ProvinceAssault
-from global_map.management.commands.fetchdata import update_province
+from global_map.models import Clan, Front, Province, ProvinceAssault, ProvinceChange
+from global_map.management.commands.fetchdata import update_province, update_clans, AssaultTimeline, \
+    active_clan_assaults, apply_provinces_data, seconds_to_prime_time, idle_job_priority, FrontRegistry, \
+    fetch_front_shard, get_or_create_provinces, crawl_page_size
 
 
 class ProvinceData(dict):
@@ -138,6 +142,61 @@ class TestUpdateProvince(TestCase):
         update_province(self.province, province_data)
         assert len(assault.battles.all()) == 4
 
+    def test_query_count_does_not_depend_on_clans(self):
+        Province.objects.create(
+            province_id='other_province_id', front=self.province.front, province_name='other_province_name',
+            arena_id='test_arena_id', arena_name='test_arena_name', prime_time='18:15', server='RU000')
+        queries_count = []
+        for province_id, competitors in [('test_province_id', [1, 2]), ('other_province_id', list(range(1, 9)))]:
+            province_data = ProvinceData(province_id=province_id, competitors=competitors, round_number=1,
+                                         owner_clan_id=9)
+            province_data.generate_battles()
+            with CaptureQueriesContext(connection) as queries:
+                update_province(self.get_province(province_data), province_data)
+            queries_count.append(len(queries))
+        assert queries_count[0] == queries_count[1]
+
+    def test_unchanged_data_skipped(self):
+        province_data = ProvinceData(competitors=[1, 2, 3, 4], round_number=1)
+        province_data.generate_battles()
+        assert update_province(self.province, province_data)
+
+        province = self.get_province(province_data)
+        with self.assertNumQueries(0):
+            assert not update_province(province, dict(province_data))
+
+    def test_new_clans(self):
+        province_data = ProvinceData(competitors=[101, 102, 103, 104], round_number=1, owner_clan_id=105)
+        province_data.generate_battles()
+        assert apply_provinces_data({self.province: province_data}) == {'updated': 1}
+
+        assault = self.get_province(province_data).assaults.get()
+        assert set(c.id for c in assault.clans.all()) == {101, 102, 103, 104}
+        assert assault.battles.count() == 2
+        assert set(Clan.objects.filter(tag=None).values_list('id', flat=True)) == {101, 102, 103, 104, 105}
+
+    def test_changes(self):
+        province_data = ProvinceData(competitors=[1, 2], round_number=1, owner_clan_id=5)
+        province_data.generate_battles()
+        update_province(self.province, province_data)
+        assert set((c.field, c.old_value, c.new_value) for c in ProvinceChange.objects.all()) == {
+            ('owner', None, '5'),
+            ('round_number', None, '1'),
+            ('battle', None, '2016-11-27T18:15:00+00:00'),
+            ('attackers', '', '1,2'),
+        }
+        battle = self.province.battles.get()
+        ProvinceChange.objects.all().delete()
+
+        # WG moved the battle and owner lost the province
+        province_data['owner_clan_id'] = None
+        province_data.generate_battles(start_at='2016-11-27T18:16:00')
+        update_province(self.province, province_data)
+        assert set((c.field, c.battle_id, c.old_value, c.new_value) for c in ProvinceChange.objects.all()) == {
+            ('owner', None, '5', None),
+            ('battle_start_at', battle.id, '2016-11-27T18:15:00+00:00', '2016-11-27T18:16:00+00:00'),
+        }
+
     def test_flow_before_prime_time(self):
         province_data = ProvinceData(attackers=[1, 2, 3])
 
@@ -164,3 +223,183 @@ class TestUpdateProvince(TestCase):
 
     def test_flow_in_prime_time(self):
         province_data = ProvinceData(attackers=self.clans[0:6])
+
+
+class TestUpdateClans(TestCase):
+    def setUp(self):
+        front = Front.objects.create(front_id='test_front_id', max_vehicle_level=99)
+        self.province = Province.objects.create(
+            province_id='test_province_id', front=front, province_name='test_province_name',
+            arena_id='test_arena_id', arena_name='test_arena_name', prime_time='18:15', server='RU000')
+        self.clans = [
+            Clan.objects.create(pk=i, tag='CLN%s' % i, title='Clan name %s' % i)
+            for i in range(1, 3)
+        ]
+
+    def test_shared_province_updated_once(self):
+        province_data = ProvinceData(attackers=[1, 2])
+        with mock.patch('global_map.management.commands.fetchdata.front_registry'), \
+                mock.patch('global_map.management.commands.fetchdata.collect_clan_related_provinces',
+                           return_value=[self.province]), \
+                mock.patch('global_map.management.commands.fetchdata.update_winners_from_log'), \
+                mock.patch('global_map.management.commands.fetchdata.update_province') as update_province_mock, \
+                mock.patch('global_map.management.commands.fetchdata.wot') as wot:
+            wot.globalmap.provinces.return_value = [province_data]
+            update_clans([1, 2])
+
+        wot.globalmap.provinces.assert_called_once_with(front_id='test_front_id', province_id='test_province_id')
+        update_province_mock.assert_called_once_with(self.province, province_data)
+
+
+class TestAssaultTimeline(TestCase):
+    def setUp(self):
+        front = Front.objects.create(front_id='test_front_id', max_vehicle_level=99)
+        self.province = Province.objects.create(
+            province_id='test_province_id', front=front, province_name='test_province_name',
+            arena_id='test_arena_id', arena_name='test_arena_name', prime_time='18:15', server='RU000')
+        assault = self.province.assaults.create(prime_time='18:15', arena_id='test_arena_id', date='2016-11-27')
+        assault.clans.add(*[Clan.objects.create(pk=i, tag='CLN%s' % i, title='Clan %s' % i) for i in range(1, 5)])
+
+    def test_hot_provinces(self):
+        now = datetime.datetime(2016, 11, 27, 12, 0, 0, tzinfo=pytz.UTC)
+        timeline = AssaultTimeline()
+        with mock.patch('global_map.models.utc_now', return_value=now):
+            timeline.rebuild(now)
+
+        assert timeline.hot_provinces(now) == set()
+        assert timeline.next_start(now) == datetime.datetime(2016, 11, 27, 18, 10, 0, tzinfo=pytz.UTC)
+        # 2 rounds for 4 clans: 18:15 and 18:45
+        assert timeline.hot_provinces(datetime.datetime(2016, 11, 27, 18, 50, 0, tzinfo=pytz.UTC)) == {self.province}
+        assert timeline.hot_provinces(datetime.datetime(2016, 11, 27, 19, 20, 0, tzinfo=pytz.UTC)) == set()
+
+
+class TestActiveClanAssaults(TestCase):
+    def setUp(self):
+        self.front = Front.objects.create(front_id='test_front_id', max_vehicle_level=99)
+        self.clan, self.other_clan = [
+            Clan.objects.create(pk=i, tag='CLN%s' % i, title='Clan %s' % i) for i in (1, 2)]
+
+    def create_assault(self, province_id, date, clans=(), owner=None):
+        province = Province.objects.create(
+            province_id=province_id, front=self.front, province_name=province_id,
+            arena_id='test_arena_id', arena_name='test_arena_name', prime_time='18:00', server='RU000')
+        assault = province.assaults.create(prime_time='18:00', arena_id='test_arena_id', date=date,
+                                           current_owner=owner)
+        assault.clans.add(*clans)
+        return assault
+
+    def test_active_assaults(self):
+        planned = self.create_assault('planned', '2016-11-28', clans=[self.clan])
+        running = self.create_assault('running', '2016-11-27', owner=self.clan)
+        self.create_assault('finished', '2016-11-26', clans=[self.clan])
+        self.create_assault('other_clan', '2016-11-28', clans=[self.other_clan])
+        for i in range(5):
+            self.create_assault('old_%s' % i, '2016-10-%02d' % (i + 1), clans=[self.clan])
+
+        now = datetime.datetime(2016, 11, 27, 20, 0, 0, tzinfo=pytz.UTC)
+        with self.assertNumQueries(1):
+            provinces = set(pa.province.province_id for pa in active_clan_assaults(self.clan, now))
+        assert provinces == {planned.province.province_id, running.province.province_id}
+
+
+class TestJobPriority(TestCase):
+    def setUp(self):
+        front = Front.objects.create(front_id='test_front_id', max_vehicle_level=99)
+        province = Province.objects.create(
+            province_id='test_province_id', front=front, province_name='test_province_name',
+            arena_id='test_arena_id', arena_name='test_arena_name', prime_time='18:15', server='RU000')
+        self.assault = province.assaults.create(prime_time='18:15', arena_id='test_arena_id', date='2016-11-27')
+        self.assault.clans.add(*[Clan.objects.create(pk=i, tag='CLN%s' % i, title='Clan %s' % i) for i in (1, 2)])
+
+    def priority(self, now):
+        with mock.patch('global_map.models.utc_now', return_value=now):
+            return seconds_to_prime_time([self.assault], now)
+
+    def test_priority(self):
+        assert self.priority(datetime.datetime(2016, 11, 27, 18, 0, 0, tzinfo=pytz.UTC)) == 15 * 60
+        # battle is running
+        assert self.priority(datetime.datetime(2016, 11, 27, 18, 30, 0, tzinfo=pytz.UTC)) == 0
+        assert self.priority(datetime.datetime(2016, 11, 28, 12, 0, 0, tzinfo=pytz.UTC)) == idle_job_priority
+
+
+class TestFrontRegistry(TestCase):
+    def setUp(self):
+        Front.objects.create(front_id='front_1', max_vehicle_level=8)
+        self.now = datetime.datetime(2016, 11, 27, 18, 0, 0, tzinfo=pytz.UTC)
+        utc_now = mock.patch('global_map.management.commands.fetchdata.utc_now', side_effect=lambda: self.now)
+        utc_now.start()
+        self.addCleanup(utc_now.stop)
+        wot = mock.patch('global_map.management.commands.fetchdata.wot')
+        self.wot = wot.start()
+        self.addCleanup(wot.stop)
+        self.wot.globalmap.info.return_value = {'state': 'active'}
+        self.wot.globalmap.fronts.return_value = [
+            {'front_id': 'front_1', 'max_vehicle_level': 10},
+            {'front_id': 'front_2', 'max_vehicle_level': 6},
+        ]
+
+    def test_fronts_are_cached_for_ttl(self):
+        registry = FrontRegistry(ttl=600)
+        assert registry.load()
+        assert registry.load()
+        assert self.wot.globalmap.fronts.call_count == 1
+        assert registry.active_front_ids == ['front_1', 'front_2']
+        assert registry.get('front_1').max_vehicle_level == 10
+        assert Front.objects.get(front_id='front_1').max_vehicle_level == 10
+        assert Front.objects.get(front_id='front_2').max_vehicle_level == 6
+
+        self.now += datetime.timedelta(seconds=601)
+        assert registry.load()
+        assert self.wot.globalmap.fronts.call_count == 2
+        assert Front.objects.count() == 2
+
+    def test_frozen_map(self):
+        self.wot.globalmap.info.return_value = {'state': 'frozen'}
+        registry = FrontRegistry(ttl=600)
+        assert not registry.load()
+        assert not registry.load()
+        assert self.wot.globalmap.info.call_count == 1
+        assert not self.wot.globalmap.fronts.called
+
+
+class TestCrawlFront(TestCase):
+    def test_shard_pages(self):
+        pages_count = 7  # the last page is short
+
+        def provinces(front_id, page_no, limit):
+            size = limit if page_no < pages_count else 1
+            return [ProvinceData(province_id='%s_%s' % (page_no, i)) for i in range(size)]
+
+        with mock.patch('global_map.management.commands.fetchdata.wot') as wot:
+            wot.globalmap.provinces.side_effect = provinces
+            front_id, provinces_data = fetch_front_shard(('front_id', 0, 3))
+
+        assert [c[1]['page_no'] for c in wot.globalmap.provinces.call_args_list] == [1, 4, 7]
+        assert len(provinces_data) == 2 * crawl_page_size + 1
+
+    def test_failed_shard_returns_fetched_pages(self):
+        with mock.patch('global_map.management.commands.fetchdata.wot') as wot:
+            wot.globalmap.provinces.side_effect = [
+                [ProvinceData(province_id=str(i)) for i in range(crawl_page_size)],
+                ValueError('bad JSON'),
+            ]
+            front_id, provinces_data = fetch_front_shard(('front_id', 1, 2))
+
+        assert [c[1]['page_no'] for c in wot.globalmap.provinces.call_args_list] == [2, 4]
+        assert len(provinces_data) == crawl_page_size
+
+    def test_get_or_create_provinces(self):
+        front = Front.objects.create(front_id='test_front_id', max_vehicle_level=10)
+        existing = Province.objects.create(
+            province_id='province_1', front=front, province_name='Old name', arena_id='test_arena_id',
+            arena_name='test_arena_name', prime_time='18:15', server='RU000')
+        provinces_data = [ProvinceData(province_id='province_%s' % i) for i in (1, 2, 3)]
+
+        # existing provinces and insert of missing ones
+        with self.assertNumQueries(2):
+            provinces = get_or_create_provinces(front, provinces_data)
+
+        assert set(provinces) == {'province_1', 'province_2', 'province_3'}
+        assert provinces['province_1'].pk == existing.pk
+        assert provinces['province_1'].province_name == 'Old name'
+        assert Province.objects.filter(front=front).count() == 3
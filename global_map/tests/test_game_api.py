@@ -0,0 +1,20 @@
+import json
+
+from django.test import SimpleTestCase
+
+from global_map.game_api import endpoint_name, iter_array_items
+
+
+class TestGameApi(SimpleTestCase):
+    def test_endpoint_name(self):
+        assert endpoint_name('clan/35039/log') == 'clan/<id>/log'
+
+    def test_iter_array_items(self):
+        data = [{'id': i, 'type': 'TOURNAMENT_BATTLE_WON', 'alias': 'p]%s' % i} for i in range(50)]
+        document = json.dumps({'total': 50, 'data': data, 'page': 1})
+        chunks = [document[i:i + 7] for i in range(0, len(document), 7)]
+        assert list(iter_array_items(chunks, 'data')) == data
+
+    def test_iter_array_items_truncated(self):
+        with self.assertRaises(ValueError):
+            list(iter_array_items(['{"data": [{"id": 1}, {"id"'], 'data'))
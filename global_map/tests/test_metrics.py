@@ -0,0 +1,27 @@
+from django.test import SimpleTestCase
+
+from global_map.metrics import Registry
+
+
+class TestMetrics(SimpleTestCase):
+    def test_render(self):
+        registry = Registry()
+        requests = registry.counter('requests_total', 'Requests')
+        latency = registry.histogram('latency_seconds', 'Latency', buckets=(0.1, 1))
+        requests.inc(endpoint='clan/<id>/log')
+        requests.inc(2, endpoint='clan/<id>/log')
+        latency.observe(0.5, stage='fronts')
+        latency.observe(5, stage='fronts')
+
+        assert registry.render('wot_').splitlines() == [
+            '# HELP wot_requests_total Requests',
+            '# TYPE wot_requests_total counter',
+            'wot_requests_total{endpoint="clan/<id>/log"} 3.0',
+            '# HELP wot_latency_seconds Latency',
+            '# TYPE wot_latency_seconds histogram',
+            'wot_latency_seconds_bucket{stage="fronts",le="0.1"} 0',
+            'wot_latency_seconds_bucket{stage="fronts",le="1.0"} 1',
+            'wot_latency_seconds_bucket{stage="fronts",le="+Inf"} 2',
+            'wot_latency_seconds_sum{stage="fronts"} 5.5',
+            'wot_latency_seconds_count{stage="fronts"} 2',
+        ]
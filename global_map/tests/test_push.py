@@ -0,0 +1,33 @@
+import json
+
+import mock
+from django.test import SimpleTestCase
+
+from global_map import push
+from global_map.management.commands.push_events import Hub
+
+
+class TestPush(SimpleTestCase):
+    def test_payloads_fit_notification(self):
+        changes = [{'province_id': 'province_%s' % i, 'field': 'owner', 'old': None, 'new': i} for i in range(500)]
+        with mock.patch('global_map.push.max_payload_size', 1000):
+            payloads = list(push.payloads({2, 1}, {'2016-11-27'}, changes))
+
+        assert len(payloads) > 1
+        assert all(len(payload) <= 1000 for payload in payloads)
+        decoded = [json.loads(payload) for payload in payloads]
+        assert all(payload['clans'] == [1, 2] and payload['dates'] == ['2016-11-27'] for payload in decoded)
+        assert sum([payload['changes'] for payload in decoded], []) == changes
+
+    def test_hub_publishes_to_subscribed_clans(self):
+        hub = Hub()
+        clan_1, clan_2 = hub.subscribe(1), hub.subscribe(2)
+        payload = {'clans': [1], 'changes': []}
+        hub.publish(payload)
+
+        assert clan_1.get_nowait() == payload
+        assert clan_2.empty()
+
+        hub.unsubscribe(1, clan_1)
+        hub.publish(payload)
+        assert clan_1.empty()
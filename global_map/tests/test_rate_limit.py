@@ -0,0 +1,43 @@
+import os
+import shutil
+import tempfile
+import time
+
+from django.test import SimpleTestCase
+from wargaming.exceptions import RequestError
+
+from global_map.rate_limit import TokenBucket, is_retryable
+
+
+class TestTokenBucket(SimpleTestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_burst_is_limited_by_capacity(self):
+        bucket = TokenBucket(rate=20, capacity=2)
+        start = time.time()
+        for i in range(4):
+            bucket.acquire()
+        # 2 tokens are available at once, 2 more are refilled in 0.1s
+        assert time.time() - start >= 0.09
+
+    def test_state_shared_between_buckets(self):
+        path = os.path.join(self.path, 'bucket')
+        first = TokenBucket(rate=10, capacity=1, path=path)
+        second = TokenBucket(rate=10, capacity=1, path=path)
+        start = time.time()
+        first.acquire()
+        second.acquire()
+        assert time.time() - start >= 0.09
+
+
+class TestIsRetryable(SimpleTestCase):
+    def test_request_errors(self):
+        assert is_retryable(RequestError(407, None, 'REQUEST_LIMIT_EXCEEDED', None))
+        assert is_retryable(RequestError(504, None, 'SOURCE_NOT_AVAILABLE', None))
+        # invalid request fails the same way on every attempt
+        assert not is_retryable(RequestError(407, 'clan_id', 'INVALID_CLAN_ID', None))
+        assert not is_retryable(RequestError(407, 'clan_id', 'CLAN_ID_LIST_LIMIT_EXCEEDED', None))
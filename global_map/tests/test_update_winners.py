@@ -0,0 +1,102 @@
+from __future__ import print_function
+
+import datetime
+import os
+import time
+import unittest
+
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+import mock
+import pytz
+
+from global_map.models import Clan, Front, Province, ProvinceAssault, ProvinceBattle
+from global_map.management.commands.fetchdata import apply_battle_log, fetch_battle_log, match_winners, \
+    BattleResult
+from global_map.tests.test_benchmarks import budget_scale
+
+
+class TestMatchWinners(TestCase):
+    def test_match_window(self):
+        start = datetime.datetime(2016, 11, 27, 18, 0, tzinfo=pytz.UTC)
+        battles = [ProvinceBattle(pk=i, start_at=start + datetime.timedelta(minutes=30 * i)) for i in range(3)]
+        logs = [
+            BattleResult('p', start + datetime.timedelta(minutes=10), 2, 1),   # battle 0
+            BattleResult('p', start + datetime.timedelta(minutes=55), 2, 2),   # too late for battle 1
+            BattleResult('p', start + datetime.timedelta(minutes=62), 3, 3),   # battle 2 started 2 minutes ago
+        ]
+        assert [(pb.pk, winner_id) for pb, winner_id in match_winners(battles, logs)] == [(0, 1), (2, 3)]
+
+
+class TestFetchBattleLog(TestCase):
+    def test_overlap(self):
+        synced_at = datetime.datetime(2016, 11, 27, 20, 0, tzinfo=pytz.UTC)
+        clan = Clan.objects.create(pk=1, tag='CLN1', title='Clan 1', battle_log_synced_at=synced_at)
+        entries = [
+            {'created_at': (synced_at - datetime.timedelta(minutes=minutes)).strftime('%Y-%m-%d %H:%M:%S'),
+             'type': 'TOURNAMENT_BATTLE_WON', 'target_province': {'alias': 'province_%s' % minutes},
+             'enemy_clan': {'id': 2}, 'winner_id': 1}
+            for minutes in (-60, 10, 30)
+        ]
+        with mock.patch('global_map.management.commands.fetchdata.game_api.iter_json_items',
+                        return_value=iter(entries)):
+            results, newest = fetch_battle_log(clan)
+
+        # battle imported by the run after its result was logged is still matched
+        assert [result.province_id for result in results] == ['province_-60', 'province_10']
+        assert newest == synced_at + datetime.timedelta(hours=1)
+
+class TestApplyBattleLogBenchmark(TestCase):
+    provinces_count = 20
+    battles_per_province = 100
+
+    def setUp(self):
+        front = Front.objects.create(front_id='front_id', max_vehicle_level=10)
+        self.clan = Clan.objects.create(pk=1, tag='CLN1', title='Clan 1')
+        Clan.objects.bulk_create([
+            Clan(pk=i, tag='C%s' % i, title='Clan %s' % i)
+            for i in range(2, self.battles_per_province + 2)
+        ])
+        start = datetime.datetime(2016, 11, 27, 18, 0, tzinfo=pytz.UTC)
+        self.entries = []
+        battles = []
+        for p in range(self.provinces_count):
+            province = Province.objects.create(
+                province_id='province_%s' % p, front=front, province_name='province', arena_id='arena_id',
+                arena_name='arena_name', prime_time='18:00', server='RU1')
+            assault = ProvinceAssault.objects.create(
+                province=province, date=start.date(), prime_time='18:00', arena_id='arena_id')
+            for i in range(self.battles_per_province):
+                start_at = start + datetime.timedelta(minutes=30 * i)
+                enemy_id = i + 2
+                battles.append(ProvinceBattle(
+                    assault=assault, province=province, arena_id='arena_id', clan_a=self.clan,
+                    clan_b_id=enemy_id, round=i + 1, start_at=start_at))
+                self.entries.append(BattleResult(
+                    province.province_id, start_at + datetime.timedelta(minutes=10),
+                    enemy_id, enemy_id if i % 2 else self.clan.pk))
+        ProvinceBattle.objects.bulk_create(battles)
+        # clan log is ordered from the newest entries
+        self.entries.sort(key=lambda log: log.created_at, reverse=True)
+
+    def test_apply_battle_log(self):
+        with CaptureQueriesContext(connection) as queries:
+            apply_battle_log(self.clan, self.entries)
+
+        total = self.provinces_count * self.battles_per_province
+        assert not ProvinceBattle.objects.filter(winner=None).exists()
+        assert ProvinceBattle.objects.filter(winner=self.clan).count() == total // 2
+        # clans, battles, winner clans, winners update, winner change events and their notification
+        assert len(queries) <= 6
+
+    @unittest.skipUnless(os.environ.get('WOT_BENCHMARK'), 'set WOT_BENCHMARK=1 to run benchmarks')
+    def test_apply_battle_log_time(self):
+        total = self.provinces_count * self.battles_per_province
+        started = time.time()
+        apply_battle_log(self.clan, self.entries)
+        elapsed = time.time() - started
+
+        print('\napply_battle_log: %s battles resolved in %.3fs (%.5fs per battle)' % (
+            total, elapsed, elapsed / total))
+        assert elapsed <= 0.0005 * total * budget_scale, 'apply_battle_log exceeded time budget'
@@ -0,0 +1,106 @@
+import datetime
+import json
+
+from django.core.cache import cache
+from django.db import connection
+from django.test import RequestFactory, TestCase
+from django.test.utils import CaptureQueriesContext
+import mock
+import pytz
+
+from global_map import data_version
+from global_map.models import Clan, ClanArenaStat, Front, Province, ProvinceChange, RefreshJob, utc_now
+from global_map.views import ListBattlesJson, ProvinceChangesJson, RefreshJobJson
+
+
+class TestListBattlesJson(TestCase):
+    def setUp(self):
+        self.front = Front.objects.create(front_id='front_id', max_vehicle_level=10)
+        self.clan = Clan.objects.create(pk=1, tag='CLN1', title='Clan 1')
+        self.owner = Clan.objects.create(pk=2, tag='CLN2', title='Clan 2')
+        self.provinces_count = 0
+
+    def create_assaults(self, count):
+        for _ in range(count):
+            i = self.provinces_count = self.provinces_count + 1
+            province = Province.objects.create(
+                province_id='province_%s' % i, front=self.front, province_name='Province %s' % i,
+                arena_id='arena_%s' % i, arena_name='Arena %s' % i, prime_time='18:00', server='RU1',
+                province_owner=self.owner)
+            assault = province.assaults.create(
+                date='2016-11-27', prime_time='18:00', arena_id=province.arena_id, current_owner=self.owner,
+                round_number=1, status='STARTED')
+            enemies = [Clan.objects.create(pk=100 * i + j, tag='C%s' % (100 * i + j)) for j in range(3)]
+            assault.clans.add(self.clan, *enemies)
+            assault.battles.create(
+                province=province, arena_id=province.arena_id, clan_a=self.clan, clan_b=enemies[0], round=1,
+                start_at=datetime.datetime(2016, 11, 27, 18, 0, tzinfo=pytz.UTC), winner=self.clan)
+            ClanArenaStat.objects.create(clan=self.clan, arena_id=province.arena_id, wins_percent=50,
+                                         battles_count=10)
+
+    def get(self, force_update=False, **headers):
+        params = {'clan_id': self.clan.pk, 'force_update': 'true' if force_update else 'false'}
+        request = RequestFactory().get('/battles/2016-11-27/', params, **headers)
+        with mock.patch('global_map.models.utc_now',
+                        return_value=datetime.datetime(2016, 11, 27, 18, 10, tzinfo=pytz.UTC)):
+            return ListBattlesJson.as_view()(request, date='2016-11-27')
+
+    def get_queries_count(self):
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.get()
+        assert response.status_code == 200
+        return len(queries)
+
+    def test_queries_count_does_not_depend_on_assaults(self):
+        self.create_assaults(1)
+        queries_count = self.get_queries_count()
+        self.create_assaults(5)
+        assert self.get_queries_count() == queries_count
+
+    def test_not_modified(self):
+        self.create_assaults(1)
+        cache.clear()
+        etag = self.get()['ETag']
+
+        # version and response lookups, no rendering
+        with self.assertNumQueries(2):
+            response = self.get(HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 304
+        for if_none_match in ['"other", %s' % etag, 'W/%s' % etag, '*']:
+            assert self.get(HTTP_IF_NONE_MATCH=if_none_match).status_code == 304
+        assert self.get(HTTP_IF_NONE_MATCH='"other"').status_code == 200
+
+        # import changed the day
+        self.create_assaults(1)
+        data_version.bump([(self.clan.pk, datetime.date(2016, 11, 27))])
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 200
+        assert response['ETag'] != etag
+
+    def test_force_update_coalesced(self):
+        self.create_assaults(1)
+        job_ids = set(self.get(force_update=True)['X-Refresh-Job'] for _ in range(3))
+        assert len(job_ids) == 1
+        job = RefreshJob.objects.get()
+        assert (job.kind, job.target, job.state) == (RefreshJob.KIND_CLAN, str(self.clan.pk), RefreshJob.STATE_PENDING)
+
+        response = RefreshJobJson.as_view()(RequestFactory().get('/jobs/%s/' % job.pk), job_id=str(job.pk))
+        assert response.status_code == 200
+
+
+class TestProvinceChangesJson(TestCase):
+    def test_recent_changes_are_held_back(self):
+        front = Front.objects.create(front_id='front_id', max_vehicle_level=10)
+        province = Province.objects.create(
+            province_id='province_id', front=front, province_name='Province', arena_id='arena_id',
+            arena_name='Arena', prime_time='18:00', server='RU1')
+        old = ProvinceChange.objects.create(province=province, field=ProvinceChange.FIELD_OWNER, new_value='1',
+                                            created_at=utc_now() - datetime.timedelta(minutes=1))
+        # may be followed by changes of import transactions which are not committed yet
+        ProvinceChange.objects.create(province=province, field=ProvinceChange.FIELD_OWNER, new_value='2')
+
+        response = ProvinceChangesJson.as_view()(RequestFactory().get('/changes/', {'since': 0}))
+        data = json.loads(response.content.decode('utf-8'))
+        assert [change['new'] for change in data['changes']] == ['1']
+        assert data['next'] == old.id
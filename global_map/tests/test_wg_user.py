@@ -0,0 +1,36 @@
+from django.db import connection
+from django.test import RequestFactory, TestCase
+from django.test.utils import CaptureQueriesContext
+
+from global_map.models import Clan
+from wot_clan_battles.middleware import WGUserMiddleware
+
+
+class TestWGUserMiddleware(TestCase):
+    def request(self, session):
+        request = RequestFactory().get('/')
+        request.session = session
+        WGUserMiddleware.process_request(request)
+        return request
+
+    def test_clan_is_not_loaded_until_read(self):
+        with CaptureQueriesContext(connection) as queries:
+            request = self.request({'user_id': '1', 'username': 'user', 'user_clan_id': 35039})
+            assert request.wg_user['username'] == 'user'
+        assert len(queries) == 0
+
+    def test_clan_is_cached_in_session(self):
+        Clan.objects.create(pk=35039, tag='CLN', title='Clan')
+        session = {'user_id': '1', 'username': 'user', 'user_clan_id': 35039}
+        assert self.request(session).wg_user['clan'].tag == 'CLN'
+        assert session['user_clan']['tag'] == 'CLN'
+
+        with CaptureQueriesContext(connection) as queries:
+            clan = self.request(session).wg_user.get('clan')
+        assert len(queries) == 0
+        assert (clan.pk, clan.tag, clan.title) == (35039, 'CLN', 'Clan')
+
+    def test_anonymous(self):
+        request = self.request({})
+        assert request.wg_user['clan'] is None
+        assert request.wg_user['id'] is None
@@ -0,0 +1,81 @@
+from datetime import timedelta
+import threading
+
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase
+
+from global_map import work_queue
+from global_map.models import RefreshJob, utc_now
+
+
+def create_job(target, priority=0, **kwargs):
+    # run_after is compared with now() of the test transaction, which started earlier
+    kwargs.setdefault('run_after', utc_now() - timedelta(hours=1))
+    return RefreshJob.objects.create(kind=RefreshJob.KIND_CLAN, target=str(target), priority=priority, **kwargs)
+
+
+class TestWorkQueue(TestCase):
+    def test_claim_by_priority(self):
+        create_job(1, priority=600)
+        create_job(2, priority=0)
+        create_job(3, priority=60)
+        create_job(4, priority=0, run_after=utc_now() + timedelta(hours=1))
+
+        assert set(job.target for job in work_queue.claim(limit=2, worker='w1')) == {'2', '3'}
+        assert set(job.target for job in work_queue.claim(limit=2, worker='w1')) == {'1'}
+        assert work_queue.claim(limit=2, worker='w1') == []
+
+    def test_expired_lease(self):
+        create_job(1)
+        job, = work_queue.claim(lease=-60, worker='w1')
+        again, = work_queue.claim(lease=600, worker='w2')
+        assert (again.pk, again.attempts, again.worker) == (job.pk, 2, 'w2')
+
+        # worker which lost the lease can't overwrite state of the new one
+        work_queue.complete([job])
+        work_queue.fail([job], 'error')
+        assert RefreshJob.objects.get(pk=job.pk).state == RefreshJob.STATE_RUNNING
+
+        work_queue.complete([again])
+        assert RefreshJob.objects.get(pk=job.pk).state == RefreshJob.STATE_DONE
+
+    def test_attempts_limit(self):
+        create_job(1, max_attempts=2)
+        job, = work_queue.claim(lease=-60)
+        work_queue.fail([job], 'error')
+        assert RefreshJob.objects.get(pk=job.pk).state == RefreshJob.STATE_PENDING
+
+        RefreshJob.objects.filter(pk=job.pk).update(run_after=utc_now() - timedelta(hours=1))
+        job, = work_queue.claim(lease=-60)
+        assert job.attempts == 2
+        # crashed on the last attempt, lease expired
+        assert work_queue.claim() == []
+        work_queue.cleanup()
+        assert RefreshJob.objects.get(pk=job.pk).state == RefreshJob.STATE_FAILED
+
+    def test_progress_renews_lease(self):
+        create_job(1)
+        job, = work_queue.claim(lease=-60)
+        work_queue.set_progress([job], 'provinces', lease=600)
+        assert work_queue.claim() == []
+        assert RefreshJob.objects.get(pk=job.pk).progress == 'provinces'
+
+
+class TestSkipLocked(TransactionTestCase):
+    def test_locked_job_skipped(self):
+        locked, free = create_job(1), create_job(2, priority=60)
+        claimed = []
+
+        def claim():
+            try:
+                claimed.extend(work_queue.claim(limit=2))
+            finally:
+                connection.close()
+
+        with transaction.atomic():
+            RefreshJob.objects.select_for_update().get(pk=locked.pk)
+            thread = threading.Thread(target=claim)
+            thread.start()
+            thread.join()
+
+        assert [job.pk for job in claimed] == [free.pk]
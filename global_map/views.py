@@ -1,18 +1,30 @@
+import hashlib
 import logging
 from datetime import datetime, timedelta, date as datetime_date
 
-import wargaming
 from django.conf import settings
 from django.db.models import Q
-from django.http import JsonResponse, QueryDict
+from django.http import HttpResponse, HttpResponseNotModified, JsonResponse, QueryDict
+from django.utils.http import parse_etags
 from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import TemplateView, View, UpdateView
 
-from global_map.models import Clan, ProvinceTag, ProvinceAssault, ClanExtra
+from global_map import data_version, metrics, work_queue
+from global_map.models import Clan, ProvinceTag, ProvinceAssault, ProvinceChange, ClanExtra, RefreshJob, \
+    load_assaults, utc_now
 
 logger = logging.getLogger(__name__)
-wot = wargaming.WoT(settings.WARGAMING_KEY, language='ru', region='ru')
-wgn = wargaming.WGN(settings.WARGAMING_KEY, language='ru', region='ru')
+
+
+def etag_matches(if_none_match, etag):
+    """Weak comparison of If-None-Match list of ETags, as used for GET"""
+    if if_none_match.strip() == '*':
+        return True
+
+    def opaque(tag):
+        # parse_etags keeps quotes and W/ since Django 1.11
+        return (tag[2:] if tag.startswith('W/') else tag).strip('"')
+    return opaque(etag) in [opaque(tag) for tag in parse_etags(if_none_match)]
 
 
 class TagView(View):
@@ -74,26 +86,51 @@ class ListBattles(TemplateView):
 class ListBattlesJson(View):
     def get(self, *args, **kwargs):
         date = kwargs.get('date')
-        clan = Clan.objects.get(pk=int(self.request.GET.get('clan_id', 35039)))
+        clan_id = int(self.request.GET.get('clan_id', 35039))
         force_update = self.request.GET.get('force_update') == 'true'
 
-        if force_update:
-            from global_map.management.commands.fetchdata import update_clan
-            update_clan(clan.id)
-
+        # refresh runs in fetchdata --queue-worker, requests of one clan share the job
+        refresh_job_id = force_update and work_queue.enqueue(RefreshJob.KIND_CLAN, clan_id, priority=0)
+
+        # response is cached until importer changes data of the clan on the day
+        today = datetime.now().date().isoformat()
+        day = date or today
+        key = 'battles:%s:%s:%s' % (clan_id, day, 'day' if date else 'current')
+        version, cached = data_version.get_with_version(clan_id, day, key)
+        if cached is None:
+            content = self.build_response(clan_id, date).content
+            cached = {'etag': '"%s"' % hashlib.sha1(content).hexdigest(), 'content': content}
+            # schedule of today depends on time as well
+            timeout = settings.BATTLES_PAST_CACHE_TTL if day < today else settings.BATTLES_CACHE_TTL
+            data_version.set_with_version(key, version, cached, timeout)
+
+        if etag_matches(self.request.META.get('HTTP_IF_NONE_MATCH', ''), cached['etag']):
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(cached['content'], content_type='application/json')
+        response['ETag'] = cached['etag']
+        if refresh_job_id:
+            response['X-Refresh-Job'] = refresh_job_id
+        return response
+
+    def build_response(self, clan_id, date):
+        clan = Clan.objects.get(pk=clan_id)
         pa_query = ProvinceAssault.objects.distinct('province').order_by('province')
         if date:
             date = datetime_date(*[int(i) for i in date.split('-')])
+            day_assaults, arena_stats = load_assaults(pa_query.filter(date=date).filter(
+                Q(battles__clan_a=clan) | Q(battles__clan_b=clan) | Q(clans=clan) | Q(current_owner=clan)))
             assaults = [
-                assault.as_clan_json(clan, current_only=False)
-                for assault in pa_query.filter(date=date).filter(
-                    Q(battles__clan_a=clan) | Q(battles__clan_b=clan) | Q(clans=clan) | Q(current_owner=clan))
+                assault.as_clan_json(clan, current_only=False, arena_stats=arena_stats)
+                for assault in day_assaults
             ]
         else:
             date = datetime.now().date()
+            day_assaults, arena_stats = load_assaults(
+                pa_query.filter(date=date).filter(Q(clans=clan) | Q(current_owner=clan)))
             assaults = [
-                assault.as_clan_json(clan)
-                for assault in pa_query.filter(date=date).filter(Q(clans=clan) | Q(current_owner=clan))
+                assault.as_clan_json(clan, arena_stats=arena_stats)
+                for assault in day_assaults
             ]
 
         # Remove assaults without battles
@@ -117,6 +154,7 @@ class ListBattlesJson(View):
             max_time = datetime.now().replace(hour=2, minute=00) + timedelta(days=1)
 
         return JsonResponse({
+            'date': date,
             'time_range': [min_time, max_time],
             'assaults': sorted(
                 assaults,
@@ -126,6 +164,50 @@ class ListBattlesJson(View):
         })
 
 
+class RefreshJobJson(View):
+    def get(self, *args, **kwargs):
+        try:
+            job = RefreshJob.objects.get(pk=int(kwargs['job_id']))
+        except RefreshJob.DoesNotExist:
+            return JsonResponse({'error': 'job not found'}, status=404)
+        return JsonResponse(job.as_json())
+
+
+class ProvinceChangesJson(View):
+    """Province change feed: /changes/?since=<last seen id>&limit=<n>
+
+    Pass "next" of the response as since to get following changes. Ids are
+    assigned on insert but rows are visible on commit, so a reader could pass
+    an id of a change which is not committed yet. Only changes older than
+    visibility_lag are returned, it is longer than any import transaction.
+    """
+    max_limit = 1000
+    visibility_lag = timedelta(seconds=30)
+
+    def get(self, *args, **kwargs):
+        try:
+            since = int(self.request.GET.get('since', 0))
+            limit = min(int(self.request.GET.get('limit', 100)), self.max_limit)
+        except ValueError:
+            return JsonResponse({'error': 'since and limit must be integers'}, status=400)
+
+        changes = list(
+            ProvinceChange.objects.filter(id__gt=since, created_at__lte=utc_now() - self.visibility_lag)
+            .select_related('province').order_by('id')[:limit])
+        return JsonResponse({
+            'changes': [change.as_json() for change in changes],
+            'next': changes[-1].id if changes else since,
+        })
+
+
+class MetricsView(View):
+    """Prometheus metrics of this web process and of the last fetchdata run"""
+
+    def get(self, *args, **kwargs):
+        return HttpResponse(metrics.registry.render('wot_web_') + metrics.textfile_contents(),
+                            content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 class UserProfile(TemplateView):
     template_name = 'user_profile.html'
 
@@ -0,0 +1,122 @@
+# coding=utf-8
+"""Distributed queue of clan and province refresh jobs stored in PostgreSQL
+
+Workers on any number of hosts claim jobs with SELECT ... FOR UPDATE SKIP
+LOCKED, so a job is never processed by two workers at once. Claimed job is
+leased: if worker dies, job is claimed again by another worker when lease
+expires. Failed jobs are retried with exponential backoff up to max_attempts.
+
+Every claim increments attempts, so (id, attempts) identifies the lease.
+Progress, completion and failure are recorded only while the job is still
+held by the same lease, a worker which lost its lease can't overwrite the
+state written by the worker which took the job over.
+"""
+from __future__ import unicode_literals
+
+from datetime import timedelta
+from functools import reduce
+import logging
+import operator
+import os
+import socket
+
+from django.db import connection
+from django.db.models import F, Q
+
+from global_map.models import RefreshJob, utc_now
+
+logger = logging.getLogger(__name__)
+
+table = RefreshJob._meta.db_table
+
+
+def worker_name():
+    return '%s:%s' % (socket.gethostname(), os.getpid())
+
+
+def enqueue(kind, target, priority=0):
+    """Queue refresh of target, returns job id
+
+    If target is already queued or running, no new job is created, its job
+    gets the most urgent of both priorities and its id is returned.
+    """
+    now = utc_now()
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'INSERT INTO {table} (kind, target, state, priority, attempts, max_attempts, run_after, '
+            'created_at, updated_at) '
+            'VALUES (%s, %s, %s, %s, 0, %s, %s, %s, %s) '
+            "ON CONFLICT (kind, target) WHERE state IN ('pending', 'running') DO UPDATE "
+            'SET priority = LEAST({table}.priority, EXCLUDED.priority), updated_at = EXCLUDED.updated_at '
+            'RETURNING id'.format(table=table),
+            [kind, str(target), RefreshJob.STATE_PENDING, priority,
+             RefreshJob._meta.get_field('max_attempts').default, now, now, now],
+        )
+        return cursor.fetchone()[0]
+
+
+def claim(limit=1, lease=600, worker=None):
+    """Lease up to limit most urgent jobs which are due, returns list of RefreshJob
+
+    Job which lease expired is claimed again until it runs out of attempts.
+    """
+    return list(RefreshJob.objects.raw(
+        'UPDATE {table} SET state = %s, worker = %s, attempts = attempts + 1, '
+        'lease_until = now() + %s * interval \'1 second\', updated_at = now() '
+        'WHERE id IN ('
+        '  SELECT id FROM {table} '
+        '  WHERE (state = %s AND run_after <= now()) '
+        '     OR (state = %s AND lease_until < now() AND attempts < max_attempts) '
+        '  ORDER BY priority, run_after LIMIT %s '
+        '  FOR UPDATE SKIP LOCKED'
+        ') RETURNING *'.format(table=table),
+        [RefreshJob.STATE_RUNNING, worker or worker_name(), lease,
+         RefreshJob.STATE_PENDING, RefreshJob.STATE_RUNNING, limit],
+    ))
+
+
+def leased(jobs):
+    """QuerySet of jobs still held by the lease they were claimed with"""
+    return RefreshJob.objects.filter(
+        reduce(operator.or_, [Q(pk=job.pk, attempts=job.attempts) for job in jobs]),
+        state=RefreshJob.STATE_RUNNING,
+    )
+
+
+def set_progress(jobs, progress, lease=None):
+    """Record stage of running jobs, lease is renewed for lease seconds if given"""
+    now = utc_now()
+    fields = {'progress': progress, 'updated_at': now}
+    if lease is not None:
+        fields['lease_until'] = now + timedelta(seconds=lease)
+    leased(jobs).update(**fields)
+
+
+def complete(jobs):
+    leased(jobs).update(state=RefreshJob.STATE_DONE, lease_until=None, updated_at=utc_now())
+
+
+def fail(jobs, error):
+    """Return jobs to queue with backoff, or mark them failed after max_attempts"""
+    now = utc_now()
+    for job in jobs:
+        if job.attempts >= job.max_attempts:
+            state, run_after = RefreshJob.STATE_FAILED, job.run_after
+            logger.error("Job %r failed after %s attempts: %s", job, job.attempts, error)
+        else:
+            state, run_after = RefreshJob.STATE_PENDING, now + timedelta(seconds=30 * 2 ** job.attempts)
+        if leased([job]).update(state=state, run_after=run_after, lease_until=None, last_error=error,
+                                updated_at=now):
+            job.state, job.run_after, job.lease_until, job.last_error = state, run_after, None, error
+
+
+def cleanup(older_than=timedelta(days=7)):
+    """Fail jobs which lease expired on the last attempt and remove finished jobs"""
+    now = utc_now()
+    RefreshJob.objects.filter(
+        state=RefreshJob.STATE_RUNNING, lease_until__lt=now, attempts__gte=F('max_attempts'),
+    ).update(state=RefreshJob.STATE_FAILED, lease_until=None, last_error='lease expired', updated_at=now)
+    RefreshJob.objects.filter(
+        state__in=[RefreshJob.STATE_DONE, RefreshJob.STATE_FAILED],
+        updated_at__lt=now - older_than,
+    ).delete()
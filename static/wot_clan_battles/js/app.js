@@ -24,7 +24,19 @@ Date.prototype.shortTime = function () {
     return this.toTimeString().substr(0,8);
 };
 
+// poll background refresh requested by force_update, reload schedule when it is over
+wait_refresh_job = function (job_id) {
+    $.get('/jobs/' + job_id + '/', function (job) {
+        if (job['state'] == 'done' || job['state'] == 'failed') {
+            refresh_clan();
+        } else {
+            setTimeout(function () { wait_refresh_job(job_id); }, 2000);
+        }
+    });
+};
+
 var selected_date = 'latest';
+var shown_date;  // day of the shown schedule, 'latest' is resolved by server
 refresh_clan = function (force_update) {
     force_update = force_update != undefined;
     var url = '/battles/';
@@ -34,7 +46,12 @@ refresh_clan = function (force_update) {
     $.get(url, {
         clan_id: $('.timetable').data('clan-id'),
         force_update: force_update
-    }, function (data) {
+    }, function (data, status, xhr) {
+        var refresh_job_id = xhr.getResponseHeader('X-Refresh-Job');
+        if (refresh_job_id)
+            wait_refresh_job(refresh_job_id);
+        shown_date = data['date'];
+
         var time_width = $('.timetable-cell').outerWidth();
         var start_date = new Date(data['time_range'][0]);
         var end_date = new Date(data['time_range'][1]);
@@ -185,19 +202,19 @@ refresh_clan = function (force_update) {
     last_updated = Date.now();
 };
 
-// Auto refresh switch
+// Auto refresh switch: pushed changes while push channel is connected, polling otherwise
 var auto_refresh = 'Off';
 var interval;
-enable_auto = function () {
-    if (auto_refresh == 'Off') {
+var push_connected = false;
+update_polling = function () {
+    clearInterval(interval);
+    if (auto_refresh == 'On' && !push_connected)
         interval = setInterval(refresh_clan, 30000);
-        auto_refresh = 'On';
-        document.getElementById('enable-auto').innerText = 'Auto-refresh: On';
-    } else {
-        clearInterval(interval);
-        auto_refresh = 'Off';
-        document.getElementById('enable-auto').innerText = 'Auto-refresh: Off';
-    }
+};
+enable_auto = function () {
+    auto_refresh = auto_refresh == 'Off' ? 'On' : 'Off';
+    document.getElementById('enable-auto').innerText = 'Auto-refresh: ' + auto_refresh;
+    update_polling();
 };
 
 // select active date
@@ -221,9 +238,46 @@ last_updated_function = function() {
         parseInt(Math.ceil((Date.now() - last_updated) / 1000)) + ' seconds ago';
 };
 
+// live changes pushed by import, see global_map/management/commands/push_events.py
+//
+// Polling is stopped while the push channel is open. When it breaks, onerror
+// turns polling back on until EventSource reconnects by itself, then the
+// schedule is reloaded once for changes missed while disconnected. Browsers
+// without EventSource keep polling.
+var push_refresh;
+var push_lost = false;
+listen_changes = function () {
+    if (!window.EventSource)
+        return;
+    var clan_id = $('.timetable').data('clan-id');
+    var events = new EventSource('/events/?clan_id=' + clan_id);
+    events.onopen = function () {
+        push_connected = true;
+        update_polling();
+        if (push_lost && auto_refresh == 'On')
+            refresh_clan();
+        push_lost = false;
+    };
+    events.onerror = function () {
+        push_connected = false;
+        push_lost = true;
+        update_polling();
+    };
+    events.addEventListener('change', function (event) {
+        var change = JSON.parse(event.data);
+        // reload only schedule which changed, other days and clans share the channel
+        if (auto_refresh != 'On' || change['clans'].indexOf(clan_id) < 0 || change['dates'].indexOf(shown_date) < 0)
+            return;
+        // import sends changes of a province in bursts, reload once per burst
+        clearTimeout(push_refresh);
+        push_refresh = setTimeout(refresh_clan, 1000);
+    });
+};
+
 // Auto start on load
 $(function () {
     refresh_clan();
     enable_auto();
+    listen_changes();
     setInterval(last_updated_function, 1000);
 });
@@ -1,14 +1,53 @@
-from global_map.models import Clan
+import time
+
+from global_map.models import Clan, get_or_create_clans
+
+clan_cache_ttl = 3600  # seconds, clan tag and title rarely change
+
+
+class WGUser(dict):
+    """Logged in WG user, clan is loaded on first access to 'clan'
+
+    Clan id, tag and title are cached in the session, so reading the clan
+    costs no queries until the cache expires. Other clan fields are deferred.
+    """
+
+    def __init__(self, session):
+        super(WGUser, self).__init__(id=session.get('user_id'), username=session.get('username'))
+        self._session = session
+
+    def __missing__(self, key):
+        if key != 'clan':
+            raise KeyError(key)
+        clan = self['clan'] = self._load_clan()
+        return clan
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def _load_clan(self):
+        clan_id = self._session.get('user_clan_id')
+        if not clan_id:
+            return None
+        clan_id = int(clan_id)
+
+        cached = self._session.get('user_clan')
+        if cached and cached['id'] == clan_id and cached['cached_at'] > time.time() - clan_cache_ttl:
+            return Clan.from_db('default', ['id', 'tag', 'title'], [clan_id, cached['tag'], cached['title']])
+
+        clan = get_or_create_clans([clan_id])[clan_id]
+        if clan.tag:
+            # new clan gets its tag from clan_resolver, it is cached on the next request
+            self._session['user_clan'] = {
+                'id': clan_id, 'tag': clan.tag, 'title': clan.title, 'cached_at': time.time(),
+            }
+        return clan
 
 
 class WGUserMiddleware(object):
     @staticmethod
     def process_request(request):
-        clan_id = request.session.get('user_clan_id')
-        clan = Clan.objects.get_or_create(pk=int(clan_id))[0] if clan_id else None
-
-        request.wg_user = {
-            'id': request.session.get('user_id'),
-            'username': request.session.get('username'),
-            'clan': clan
-        }
+        request.wg_user = WGUser(request.session)
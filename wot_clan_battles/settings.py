@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/1.9/ref/settings/
 """
 
 import os
+import tempfile
 import yaml
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
@@ -166,3 +167,46 @@ DATETIME_FORMAT = 'r'
 
 config = yaml.load(open(os.path.join(BASE_DIR, 'config.yaml')).read())
 WARGAMING_KEY = config['WARGAMING_KEY']
+
+# WG API is called through python-wargaming, unless base URL of another server (e.g.
+# ./manage.py fake_wgapi stand-in) is set
+WG_API_URL = os.environ.get('WG_API_URL') or None
+
+# Unofficial global map API, see global_map/game_api.py
+GAME_API_URL = os.environ.get('GAME_API_URL') or 'https://ru.wargaming.net/globalmap/game_api/'
+GAME_API_TIMEOUT = (3.05, 30)  # connect and read timeouts, seconds
+GAME_API_POOL_SIZE = 10  # max keep-alive connections shared by import threads
+
+# Record/replay cache of WG API responses, see global_map/api_cache.py
+WG_API_CACHE = {
+    'MODE': os.environ.get('WG_API_CACHE_MODE') or None,  # None, 'record', 'replay' or 'ttl'
+    'PATH': os.environ.get('WG_API_CACHE_PATH') or os.path.join(BASE_DIR, 'wgapi_cache'),
+    'TTL': 60,  # seconds, for 'ttl' mode
+}
+
+# Shared by all uwsgi workers and importers, create table with ./manage.py createcachetable
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'global_map_cache',
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    },
+}
+
+# Seconds to cache schedule of the current day and of past days. Both are rebuilt as soon as data
+# version changes, see global_map/data_version.py; past days expire anyway to pick up clan tags
+# and arena stats, which are updated without version bump
+BATTLES_CACHE_TTL = 60
+BATTLES_PAST_CACHE_TTL = 3600
+
+# Import metrics are written to this file by fetchdata and included into /metrics/, None to disable
+METRICS_TEXTFILE = os.environ.get('METRICS_TEXTFILE', os.path.join(tempfile.gettempdir(), 'wot_battles.prom'))
+
+# Throttling of WG API calls, see global_map/rate_limit.py
+WG_API_RATE_LIMIT = {
+    'WG_API_RATE': 10,  # requests per second allowed for WARGAMING_KEY
+    'GAME_API_RATE': 10,  # requests per second to unofficial global map API
+    'RETRIES': 5,  # attempts of rate limited or failed requests
+    # bucket state is shared through files in this directory by all processes, None to limit each process alone
+    'STATE_DIR': tempfile.gettempdir(),
+}
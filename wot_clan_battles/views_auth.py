@@ -2,13 +2,10 @@ import six
 
 from django.http import HttpResponseRedirect
 from django.shortcuts import reverse
-from django.conf import settings
 
 from openid.consumer import consumer
 
-import wargaming
-
-wot = wargaming.WoT(settings.WARGAMING_KEY, language='ru', region='ru')
+from global_map.models import wot
 
 
 def auth_callback(request):
@@ -21,6 +18,7 @@ def auth_callback(request):
         request.session['user_id'] = user_id
         request.session['username'] = username
         request.session['user_clan_id'] = wot.account.info(account_id=user_id)[str(user_id)]['clan_id']
+        request.session.pop('user_clan', None)
     return HttpResponseRedirect('/')
 
 